@@ -0,0 +1,291 @@
+# assign.py
+# assignment and centroid update steps of k-means with cosine similarity
+# over a Corpus
+
+import numpy as np
+
+# upper bound on the number of (nonzero, centroid) products held in memory
+# at once by assign(), 2**22 float64 values is 32MB
+BLOCK_ELEMENTS = 1 << 22
+
+def normalize_centroids(centroids, dtype=np.float64):
+    """ Return the centroids as a (K, nwords) array of unit-length rows,
+        normalized in float64 and then stored as dtype.  All-zero centroids
+        (empty clusters) stay zero and never win. """
+    centroids = np.array(centroids, dtype=np.float64)
+    norms = np.sqrt(np.sum(np.square(centroids), axis=1))
+    norms[norms == 0] = 1
+    centroids /= norms[:, np.newaxis]
+    return centroids.astype(dtype, copy=False)
+
+def row_blocks(corpus, k, block_elements=BLOCK_ELEMENTS):
+    """ Yield (start, end) row ranges whose nonzeros times k stay under
+        block_elements, always at least one row per block """
+    return offset_blocks(corpus.indptr, k, block_elements)
+
+def offset_blocks(indptr, k, block_elements=BLOCK_ELEMENTS):
+    """ row_blocks() over the row offsets indptr of any set of rows """
+    max_nnz = max(1, block_elements // max(1, k))
+    start = 0
+    nrows = len(indptr) - 1
+    while start < nrows:
+        end = np.searchsorted(indptr, indptr[start] + max_nnz, side='right') - 1
+        end = min(max(end, start + 1), nrows)
+        yield start, end
+        start = end
+
+def block_similarities(corpus, start, end, centroids_t, row_norms):
+    """ Cosine similarity of rows start:end against every centroid.
+
+        centroids_t is the (nwords, K) transpose of the normalized centroids,
+        so a single fancy-index gathers the centroid weights of every nonzero
+        in the block.  The products are then summed per row with reduceat,
+        which is a sparse-times-dense product without the python loop.
+        A dense corpus is a plain matrix product.
+    """
+    k = centroids_t.shape[1]
+    lo, hi = corpus.indptr[start], corpus.indptr[end]
+    if corpus.dense:
+        sims = np.dot(corpus.dense_values()[start:end], centroids_t)
+        sims /= row_norms[start:end, np.newaxis]
+        return sims
+    products = centroids_t[corpus.word_ids[lo:hi]]
+    products *= corpus.values[lo:hi, np.newaxis]
+    offsets = corpus.indptr[start:end] - lo
+    nonempty = corpus.indptr[start+1:end+1] - lo > offsets
+    sims = np.zeros((end - start, k))
+    if hi > lo:
+        # reduceat would copy a single element for empty rows, skip them
+        sims[nonempty] = np.add.reduceat(products, offsets[nonempty], axis=0)
+    sims /= row_norms[start:end, np.newaxis]
+    return sims
+
+def assign(corpus, centroids, row_norms=None, callback=None):
+    """ Find the most similar centroid for every row of corpus.
+
+        centroids is a (K, nwords) array, it is normalized once here and
+        kept in the precision of the corpus values, so a float32 corpus
+        also gathers float32 centroid weights.  row_norms can be passed in
+        to avoid recomputing them every pass.  callback, if given, is called
+        with the number of rows done after every block.  Returns (labels,
+        similarities) where labels is an int32 array of cluster ids and
+        similarities the winning cosines.
+    """
+    if row_norms is None:
+        row_norms = corpus.row_norms()
+    centroids_t = np.ascontiguousarray(normalize_centroids(centroids, corpus.values.dtype).T)
+    k = centroids_t.shape[1]
+    labels = np.empty(len(corpus), dtype=np.int32)
+    similarities = np.empty(len(corpus))
+    for start, end in row_blocks(corpus, k):
+        sims = block_similarities(corpus, start, end, centroids_t, row_norms)
+        labels[start:end] = np.argmax(sims, axis=1)
+        similarities[start:end] = sims[np.arange(end - start), labels[start:end]]
+        if callback is not None:
+            callback(end)
+    return labels, similarities
+
+def cluster_sums(corpus, labels, k):
+    """ Return (sums, counts): the (k, nwords) per-cluster sum of the rows
+        of corpus and the (k,) number of rows in each cluster.
+
+        Sums rather than means are what can be added up exactly across
+        ranks or batches; divide with cluster_means() once combined.
+        bincount adds in float64 whatever the precision of the values.
+    """
+    counts = np.bincount(labels, minlength=k)
+    if corpus.dense:
+        # rows sorted by cluster, summed per cluster in float64
+        order = np.argsort(labels, kind="mergesort")
+        starts = np.append(0, np.cumsum(counts))[:-1]
+        sums = np.zeros((k, corpus.nwords))
+        nonempty = counts > 0
+        if nonempty.any():
+            sums[nonempty] = np.add.reduceat(corpus.dense_values()[order],
+                                             starts[nonempty], axis=0, dtype=np.float64)
+        return sums, counts
+    flat = labels[corpus.row_of_nonzeros()].astype(np.int64) * corpus.nwords
+    flat += corpus.word_ids
+    sums = np.bincount(flat, weights=corpus.values,
+                       minlength=k * corpus.nwords).reshape(k, corpus.nwords)
+    return sums, counts
+
+def cluster_means(sums, counts, centroids, dtype=np.float64):
+    """ Return the new (k, nwords) centroids sums / counts as dtype.  Empty
+        clusters keep their previous centroid from centroids. """
+    means = np.array(centroids, dtype=np.float64)
+    nonempty = counts > 0
+    means[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+    return means.astype(dtype, copy=False)
+
+def similarity_distance(similarities):
+    """ euclidian distance between unit vectors with the given cosines """
+    return np.sqrt(np.maximum(2 - 2 * similarities, 0))
+
+def assigned_similarities(corpus, unit_centroids, labels, row_norms):
+    """ Cosine similarity of every row to the one centroid it is labeled
+        with, without scoring the other K-1 centroids """
+    if corpus.dense:
+        sims = np.einsum('ij,ij->i', corpus.dense_values(), unit_centroids[labels])
+        return sims / row_norms
+    sims = np.zeros(len(corpus))
+    nonempty = corpus.row_lengths() > 0
+    if nonempty.any():
+        products = unit_centroids[labels[corpus.row_of_nonzeros()], corpus.word_ids]
+        products *= corpus.values
+        sims[nonempty] = np.add.reduceat(products, corpus.indptr[:-1][nonempty])
+    return sims / row_norms
+
+def top_two(corpus, unit_centroids, row_norms):
+    """ Return (labels, best, second): the most similar centroid of every
+        row, its similarity and the similarity of the runner up """
+    centroids_t = np.ascontiguousarray(unit_centroids.T)
+    k = centroids_t.shape[1]
+    labels = np.empty(len(corpus), dtype=np.int32)
+    best = np.empty(len(corpus))
+    second = np.empty(len(corpus))
+    second.fill(-1)
+    for start, end in row_blocks(corpus, k):
+        sims = block_similarities(corpus, start, end, centroids_t, row_norms)
+        rows = np.arange(end - start)
+        labels[start:end] = np.argmax(sims, axis=1)
+        best[start:end] = sims[rows, labels[start:end]]
+        if k > 1:
+            sims[rows, labels[start:end]] = -np.inf
+            second[start:end] = np.max(sims, axis=1)
+    return labels, best, second
+
+class PrunedAssigner(object):
+    """ Assignment that skips centroids which cannot win, after Hamerly
+        ("Making k-means even faster", 2010), on the unit sphere.
+
+        Tracks and centroids are compared as unit vectors, where the
+        euclidian distance sqrt(2 - 2 cos) obeys the triangle inequality.
+        Every track keeps one lower bound on the distance to any centroid
+        other than its own, which shrinks by the largest drift of the others
+        when a pass moves the centroids.  The distance to the own centroid
+        is computed exactly every pass, one gather per nonzero rather than
+        K, so the similarities returned are exact.  Only the tracks whose
+        own distance passes the lower bound or half the distance from their
+        centroid to the nearest other one are scored against every centroid.
+        Elkan's variant keeps K lower bounds per track, which is too much
+        memory at the K values we sweep.
+
+        This rarely pays off in the 5000-dimension sparse tfidf space: the
+        tracks are nearly orthogonal to every centroid, so the gaps between
+        centroids are small next to the distances and most tracks are
+        rescored in full every pass.  Check the fraction of pairs scored it
+        reports before relying on it.
+    """
+
+    def __init__(self, corpus, row_norms=None):
+        if row_norms is None:
+            row_norms = corpus.row_norms()
+        self.corpus = corpus
+        self.row_norms = row_norms
+        self.unit = None
+        self.labels = None
+        self.lower = None
+        # similarity computations done and possible in the last pass
+        self.computed = 0
+        self.possible = 0
+
+    def assign(self, centroids, callback=None):
+        """ Same contract as assign(), but remembers bounds between calls """
+        unit = normalize_centroids(centroids)
+        ntracks = len(self.corpus)
+        k = len(unit)
+        self.possible = ntracks * k
+        if self.labels is None:
+            self.labels, best, second = top_two(self.corpus, unit, self.row_norms)
+            self.lower = similarity_distance(second)
+            self.unit = unit
+            self.computed = self.possible
+            if callback is not None:
+                callback(ntracks)
+            return self.labels.copy(), best
+
+        drift = np.sqrt(np.sum(np.square(unit - self.unit), axis=1))
+        self.unit = unit
+        if k > 1:
+            order = np.argsort(drift)
+            fastest, max1, max2 = order[-1], drift[order[-1]], drift[order[-2]]
+            self.lower -= np.where(self.labels == fastest, max2, max1)
+
+        # half the distance from every centroid to its nearest neighbour
+        between = similarity_distance(unit.dot(unit.T))
+        np.fill_diagonal(between, np.inf)
+        half_gap = np.min(between, axis=1) / 2
+
+        similarities = assigned_similarities(self.corpus, unit, self.labels, self.row_norms)
+        upper = similarity_distance(similarities)
+        bound = np.maximum(half_gap[self.labels], self.lower)
+        check = np.flatnonzero(upper > bound)
+        # the own centroid of a rescored track is not counted twice
+        self.computed = ntracks + len(check) * (k - 1)
+        if len(check):
+            self.rescore(check, unit, similarities)
+        if callback is not None:
+            callback(ntracks)
+        return self.labels.copy(), similarities
+
+    def rescore(self, check, unit, similarities):
+        """ Score the rows check against every centroid, reading them from
+            the corpus in place, and update their labels, similarities and
+            lower bounds """
+        corpus = self.corpus
+        centroids_t = np.ascontiguousarray(unit.T)
+        k = centroids_t.shape[1]
+        lengths = corpus.indptr[check + 1] - corpus.indptr[check]
+        offsets = np.append(0, np.cumsum(lengths))
+        for start, end in offset_blocks(offsets, k):
+            rows = check[start:end]
+            if corpus.dense:
+                sims = np.dot(corpus.dense_values()[rows], centroids_t)
+            else:
+                # position of every nonzero of the block, as in Corpus.take()
+                lo, hi = offsets[start], offsets[end]
+                nonzeros = (np.repeat(corpus.indptr[rows] - offsets[start:end], lengths[start:end])
+                            + np.arange(lo, hi))
+                products = centroids_t[corpus.word_ids[nonzeros]]
+                products *= corpus.values[nonzeros, np.newaxis]
+                sims = np.zeros((end - start, k))
+                nonempty = lengths[start:end] > 0
+                if hi > lo:
+                    sims[nonempty] = np.add.reduceat(
+                            products, offsets[start:end][nonempty] - lo, axis=0)
+            sims /= self.row_norms[rows, np.newaxis]
+            index = np.arange(end - start)
+            labels = np.argmax(sims, axis=1)
+            self.labels[rows] = labels
+            similarities[rows] = sims[index, labels]
+            if k > 1:
+                sims[index, labels] = -np.inf
+                self.lower[rows] = similarity_distance(np.max(sims, axis=1))
+
+def add_moved_sums(sums, counts, corpus, old_labels, new_labels):
+    """ Turn sums and counts, cluster_sums() of old_labels or any running
+        total of them, into those of new_labels in place.  Only the rows
+        whose label changed are read, each is subtracted from its old
+        cluster and added to its new one, and only the (cluster, word)
+        entries they touch are written, so the cost follows the moved
+        nonzeros rather than K times the vocabulary. """
+    moved = np.flatnonzero(old_labels != new_labels)
+    k = len(counts)
+    counts += (np.bincount(new_labels[moved], minlength=k) -
+               np.bincount(old_labels[moved], minlength=k))
+    if not len(moved):
+        return
+    if corpus.dense:
+        rows = corpus.dense_values()[moved]
+        np.add.at(sums, new_labels[moved], rows)
+        np.subtract.at(sums, old_labels[moved], rows)
+        return
+    sub = corpus.take(moved)
+    rows = sub.row_of_nonzeros()
+    added = new_labels[moved][rows].astype(np.int64) * corpus.nwords + sub.word_ids
+    removed = old_labels[moved][rows].astype(np.int64) * corpus.nwords + sub.word_ids
+    touched, inverse = np.unique(np.concatenate([added, removed]), return_inverse=True)
+    delta = np.bincount(inverse.ravel(), weights=np.concatenate([sub.values, -sub.values]),
+                        minlength=len(touched))
+    sums[touched // corpus.nwords, touched % corpus.nwords] += delta
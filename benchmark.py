@@ -0,0 +1,168 @@
+# benchmark.py
+# time the stages of the pipeline on a synthetic corpus, report JSON
+#
+# A synthetic mxm_dataset.db (see synthetic.py) is pushed through every
+# stage: the tfidf build, loading the corpus from sqlite and from the binary
+# format, an assignment pass, the centroid update and the reconcile
+# Allreduce.  Each timed stage runs --repeat times and the best and median
+# times are reported.  With --baseline the results are compared against an
+# earlier report and the run fails if a stage got slower than --tolerance.
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+from time import time
+import numpy as np
+import synthetic
+import get_tfidf
+from read_tfidf import TFIDFDb
+from corpus import Corpus
+from assign import assign, cluster_sums, cluster_means
+from seeding import random_rows
+
+STAGES = [ "tfidf", "load_db", "load_binary", "assign", "update", "reconcile" ]
+
+def timed(func, repeat):
+    """ Run func repeat times, return (last result, list of seconds) """
+    runs = []
+    result = None
+    for i in xrange(repeat):
+        start = time()
+        result = func()
+        runs.append(time() - start)
+    return result, runs
+
+def stats(runs):
+    return { "best": min(runs), "median": float(np.median(runs)), "runs": runs }
+
+def quiet(func):
+    """ func with stdout sent to stderr, so only the report goes to stdout """
+    def run():
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        try:
+            return func()
+        finally:
+            sys.stdout = stdout
+    return run
+
+def reconcile_buffer(k, nwords):
+    """ Return a function doing the per-pass Allreduce of k_means_mpi.py,
+        or None without mpi4py """
+    try:
+        from mpi4py import MPI
+    except ImportError:
+        return None
+    reduction = np.ones((k, nwords + 1))
+    return lambda: MPI.COMM_WORLD.Allreduce(MPI.IN_PLACE, reduction, op=MPI.SUM)
+
+def run(workdir, tracks, k, repeat, seed=0):
+    """ Return the report of one benchmark run in workdir """
+    raw_db = os.path.join(workdir, "mxm_dataset.db")
+    tfidf_db = os.path.join(workdir, "mxm_tfidf.db")
+    corpus_dir = os.path.join(workdir, "mxm_tfidf.corpus")
+    stages = {}
+
+    start = time()
+    synthetic.generate(raw_db, tracks, seed=seed)
+    generate_seconds = time() - start
+
+    def build():
+        if os.path.exists(tfidf_db):
+            os.remove(tfidf_db)
+        get_tfidf.main(raw_db, tfidf_db)
+    stages["tfidf"] = stats(timed(quiet(build), repeat)[1])
+    corpus, runs = timed(lambda: TFIDFDb(tfidf_db).corpus(), repeat)
+    stages["load_db"] = stats(runs)
+    corpus.save(corpus_dir)
+    # touch every value, a bare memory map costs nothing until it is read
+    runs = timed(lambda: Corpus.load(corpus_dir).values.sum(), repeat)[1]
+    stages["load_binary"] = stats(runs)
+
+    rng = np.random.RandomState(seed)
+    centroids = random_rows(corpus, k, rng)
+    row_norms = corpus.row_norms()
+    (labels, similarities), runs = timed(lambda: assign(corpus, centroids, row_norms), repeat)
+    stages["assign"] = stats(runs)
+    def update():
+        sums, counts = cluster_sums(corpus, labels, k)
+        return cluster_means(sums, counts, centroids)
+    stages["update"] = stats(timed(update, repeat)[1])
+    reconcile = reconcile_buffer(k, corpus.nwords)
+    if reconcile is not None:
+        stages["reconcile"] = stats(timed(reconcile, repeat)[1])
+
+    return { "config": { "tracks": tracks, "k": k, "repeat": repeat, "seed": seed,
+                         "words": synthetic.NUM_WORDS, "zipf": synthetic.ZIPF_EXPONENT,
+                         "median_tokens": synthetic.MEDIAN_TOKENS },
+             "corpus": { "tracks": len(corpus), "words": corpus.nwords, "nnz": corpus.nnz },
+             "generate_seconds": generate_seconds,
+             "stages": stages,
+             "platform": { "python": platform.python_version(), "numpy": np.__version__,
+                           "machine": platform.machine() } }
+
+def compare(report, baseline, tolerance):
+    """ Return {stage: best / baseline best} and the stages slower than
+        1 + tolerance times the baseline """
+    ratios = {}
+    for stage, result in report["stages"].iteritems():
+        old = baseline.get("stages", {}).get(stage)
+        if old and old["best"] > 0:
+            ratios[stage] = result["best"] / old["best"]
+    slower = sorted(stage for stage, ratio in ratios.iteritems() if ratio > 1 + tolerance)
+    return ratios, slower
+
+def dbg(message):
+    sys.stderr.write(message + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the clustering pipeline "
+                                                 "on a synthetic corpus")
+    parser.add_argument("--tracks", type=int, default=synthetic.NUM_TRACKS,
+                        help="songs in the synthetic corpus (default {})".format(synthetic.NUM_TRACKS))
+    parser.add_argument("-k", type=int, default=50,
+                        help="number of centroids for the assignment stage (default 50)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of every stage (default 3)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default 0)")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the JSON report to FILE instead of stdout")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare against the JSON report in FILE")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="with --baseline, fail when a stage is more than this "
+                             "fraction slower (default 0.1)")
+    parser.add_argument("--workdir",
+                        help="keep the generated databases here instead of a "
+                             "temporary directory")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="mxm_bench")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    try:
+        report = run(workdir, args.tracks, args.k, args.repeat, args.seed)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    slower = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            ratios, slower = compare(report, json.load(f), args.tolerance)
+        report["baseline"] = { "file": args.baseline, "ratios": ratios, "slower": slower }
+        for stage in STAGES:
+            if stage in ratios:
+                dbg("{:12} {:6.2f}x baseline{}".format(stage, ratios[stage],
+                        "  SLOWER" if stage in slower else ""))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    sys.exit(1 if slower else 0)
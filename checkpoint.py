@@ -0,0 +1,96 @@
+# checkpoint.py
+# binary checkpoints of a k-means run, so a killed job can be resumed
+#
+# A checkpoint is a single .npz file holding the centroid matrix, the label
+# of every track (keyed by track id, so it can be resumed with a different
+# number of ranks), the pass number, the objective, the random generator
+# state, the command line parameters of the run and a hash of the
+# vocabulary the centroids are over.
+
+import os
+import json
+import hashlib
+import numpy as np
+
+class Checkpoint(object):
+    """ State of a run after npass passes """
+
+    def __init__(self, centroids, track_ids, labels, npass, objective=None,
+                 rng_state=None, params=None, vocabulary=None):
+        self.centroids = centroids
+        self.track_ids = track_ids
+        self.labels = labels
+        self.npass = npass
+        self.objective = objective
+        self.rng_state = rng_state
+        self.params = params or {}
+        # vocabulary_hash() of the words of the corpus
+        self.vocabulary = vocabulary
+
+    def check_vocabulary(self, words):
+        """ Raise ValueError unless the centroids are over words, the
+            vocabulary of the corpus the run is resumed on.  Checkpoints
+            without a vocabulary hash are only checked for its size. """
+        nwords = np.shape(self.centroids)[1]
+        if nwords != len(words):
+            raise ValueError("the checkpoint centroids have {} words, the corpus has {}, "
+                             "it was written for another corpus".format(nwords, len(words)))
+        if self.vocabulary is not None and self.vocabulary != vocabulary_hash(words):
+            raise ValueError("the checkpoint was written for a different vocabulary "
+                             "of {} words than the corpus".format(nwords))
+
+    def labels_for(self, track_ids):
+        """ Return the checkpointed label of each of the given track ids,
+            -1 for tracks the checkpoint does not know """
+        if not len(self.track_ids):
+            return -np.ones(len(track_ids), dtype=np.int32)
+        order = np.argsort(self.track_ids)
+        known = self.track_ids[order]
+        track_ids = np.asarray(track_ids).astype(known.dtype)
+        pos = np.minimum(np.searchsorted(known, track_ids), len(known) - 1)
+        labels = self.labels[order][pos]
+        labels[known[pos] != track_ids] = -1
+        return labels
+
+def vocabulary_hash(words):
+    """ sha1 of the words in order, identifies a vocabulary """
+    return hashlib.sha1(u"\n".join(words).encode('utf-8')).hexdigest()
+
+def save_checkpoint(path, checkpoint):
+    """ Write checkpoint to path atomically: the file is written next to
+        path and renamed over it, so path always holds a whole checkpoint """
+    arrays = { "centroids": checkpoint.centroids,
+               "track_ids": np.asarray(checkpoint.track_ids).astype(np.string_),
+               "labels": np.asarray(checkpoint.labels, dtype=np.int32),
+               "npass": np.array(checkpoint.npass),
+               "params": np.array(json.dumps(checkpoint.params)) }
+    if checkpoint.objective is not None:
+        arrays["objective"] = np.array(checkpoint.objective)
+    if checkpoint.vocabulary is not None:
+        arrays["vocabulary"] = np.array(checkpoint.vocabulary)
+    if checkpoint.rng_state is not None:
+        name, keys, pos, has_gauss, gauss = checkpoint.rng_state
+        arrays["rng_keys"] = keys
+        arrays["rng_misc"] = np.array([pos, has_gauss, gauss])
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+def load_checkpoint(path):
+    with np.load(path) as data:
+        objective = None
+        if "objective" in data:
+            objective = float(data["objective"])
+        rng_state = None
+        if "rng_keys" in data:
+            pos, has_gauss, gauss = data["rng_misc"]
+            rng_state = ('MT19937', data["rng_keys"], int(pos), int(has_gauss), float(gauss))
+        vocabulary = None
+        if "vocabulary" in data:
+            vocabulary = str(data["vocabulary"])
+        return Checkpoint(data["centroids"], data["track_ids"], data["labels"],
+                          int(data["npass"]), objective, rng_state,
+                          json.loads(str(data["params"])), vocabulary)
@@ -0,0 +1,100 @@
+# convergence.py
+# stopping rules for the k-means passes
+
+import numpy as np
+from assign import normalize_centroids
+
+def centroid_shift(old_centroids, new_centroids):
+    """ Return the largest cosine distance (1 - cosine similarity) any
+        centroid moved between two passes """
+    old = normalize_centroids(old_centroids)
+    new = normalize_centroids(new_centroids)
+    return float(np.max(1 - np.sum(old * new, axis=1)))
+
+class Convergence(object):
+    """ Decides when to stop iterating.  A run stops as soon as any rule
+        holds after a pass:
+
+        max_passes      -- this many passes have been made
+        tolerance       -- no centroid moved more than this cosine distance
+        max_changed     -- at most this fraction of tracks changed cluster
+        min_improvement -- the objective (total cosine similarity of tracks
+                           to their centroid) improved by less than this
+                           fraction, None disables the rule
+
+        The defaults only stop once nothing changes any more, or after 100
+        passes, whichever comes first.
+    """
+
+    def __init__(self, max_passes=100, tolerance=0.0, max_changed=0.0,
+                 min_improvement=None):
+        self.max_passes = max_passes
+        self.tolerance = tolerance
+        self.max_changed = max_changed
+        self.min_improvement = min_improvement
+        self.npass = 0
+        self.changed = None
+        self.shift = None
+        self.objective = None
+        self.last_objective = None
+        self.reason = None
+
+    def update(self, nchanged, ntracks, objective, shift):
+        """ Record the statistics of a finished pass and return True when
+            the run should stop.  nchanged is the number of tracks whose
+            label changed, objective the summed similarity, shift the value
+            of centroid_shift() for the centroid update. """
+        self.npass += 1
+        self.changed = nchanged / float(max(ntracks, 1))
+        self.shift = shift
+        self.last_objective, self.objective = self.objective, objective
+        self.reason = self._check()
+        return self.reason is not None
+
+    def restore(self, npass, objective):
+        """ Continue counting from a checkpointed run """
+        self.npass = npass
+        self.objective = objective
+
+    def improvement(self):
+        if self.last_objective is None:
+            return None
+        return (self.objective - self.last_objective) / max(abs(self.last_objective), 1e-12)
+
+    def _check(self):
+        if self.changed <= self.max_changed:
+            return "{:.4%} of labels changed".format(self.changed)
+        if self.shift <= self.tolerance:
+            return "centroids moved {:.3g}".format(self.shift)
+        improvement = self.improvement()
+        if (self.min_improvement is not None and improvement is not None
+                and improvement < self.min_improvement):
+            return "objective improved {:.3g}".format(improvement)
+        if self.max_passes is not None and self.npass >= self.max_passes:
+            return "reached {} passes".format(self.npass)
+        return None
+
+    @staticmethod
+    def add_arguments(parser):
+        """ Add the stopping rule options to an argparse parser """
+        parser.add_argument("--max-passes", type=int, default=100,
+                            help="stop after this many passes (default 100)")
+        parser.add_argument("--tolerance", type=float, default=0.0,
+                            help="stop when no centroid moves more than this "
+                                 "cosine distance (default 0)")
+        parser.add_argument("--max-changed", type=float, default=0.0,
+                            help="stop when at most this fraction of tracks "
+                                 "change cluster (default 0)")
+        parser.add_argument("--min-improvement", type=float, default=None,
+                            help="stop when the objective improves by less "
+                                 "than this fraction (default off)")
+
+    @classmethod
+    def from_args(cls, args):
+        """ Build a Convergence from options added by add_arguments() """
+        return cls(args.max_passes, args.tolerance, args.max_changed,
+                   args.min_improvement)
+
+    def status(self):
+        return "Pass# {:3}  changed {:.3%}  shift {:.3g}  objective {:.6g}".format(
+                self.npass, self.changed, self.shift, self.objective)
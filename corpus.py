@@ -0,0 +1,252 @@
+# corpus.py
+# compressed sparse row (CSR) representation of the tfidf corpus, shared by
+# k_means.py and k_means_mpi.py
+
+import io
+import os
+from array import array
+import numpy as np
+
+# files of a binary corpus directory, see Corpus.save()
+INDPTR_FILE = "indptr.npy"
+WORD_IDS_FILE = "word_ids.npy"
+VALUES_FILE = "values.npy"
+TRACK_IDS_FILE = "track_ids.npy"
+WORDS_FILE = "words.txt"
+# optional, written by export_corpus.py for model files
+IDF_FILE = "idf.npy"
+# written by project_corpus.py, the projection a projected corpus was made with
+PROJECTION_FILE = "projection.npz"
+
+class Corpus(object):
+    """ Sparse matrix of tfidf scores with one row per track.
+
+        indptr    -- row offsets, row i spans indptr[i]:indptr[i+1]
+        word_ids  -- int32 word (column) id of every nonzero, or None for a
+                     dense corpus whose rows store every word in order
+        values    -- tfidf score of every nonzero, float64 unless they are
+                     float32 already (see astype())
+        track_ids -- track_id of every row
+        words     -- vocabulary, words[word_id] is the word string
+
+        Compared to a { track_id : { word : tfidf } } cache this costs 12
+        bytes per nonzero instead of several hundred, and lets the k-means
+        passes work on whole numpy arrays instead of python dicts.
+
+        A dense corpus, such as a projected one (see projection.py), keeps
+        only its values, row after row; dense_values() views them as a
+        (tracks, nwords) matrix.
+    """
+
+    def __init__(self, indptr, word_ids, values, track_ids, words):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.dense = word_ids is None
+        self._word_ids = None if self.dense else np.asarray(word_ids, dtype=np.int32)
+        values = np.asarray(values).reshape(-1)
+        if values.dtype != np.float32:
+            values = values.astype(np.float64, copy=False)
+        self.values = values
+        self.track_ids = np.asarray(track_ids)
+        self.words = list(words)
+
+    def __len__(self):
+        return len(self.track_ids)
+
+    def __iter__(self):
+        """ yield (track_id, word_ids, values) for every row """
+        for i in xrange(len(self)):
+            word_ids, values = self.row(i)
+            yield self.track_ids[i], word_ids, values
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    @property
+    def nwords(self):
+        return len(self.words)
+
+    @property
+    def word_ids(self):
+        """ The word id of every nonzero.  A dense corpus builds them on
+            first use, 4 more bytes per value; the steps of a k-means pass
+            do not ask for them. """
+        if self._word_ids is None:
+            self._word_ids = np.tile(np.arange(self.nwords, dtype=np.int32), len(self))
+        return self._word_ids
+
+    def dense_values(self):
+        """ The values of a dense corpus as a (tracks, nwords) view """
+        return self.values.reshape(len(self), self.nwords)
+
+    def row(self, i):
+        """ Return the (word_ids, values) arrays of row i without copying """
+        start, end = self.indptr[i], self.indptr[i+1]
+        if self.dense:
+            return np.arange(self.nwords, dtype=np.int32), self.values[start:end]
+        return self.word_ids[start:end], self.values[start:end]
+
+    def dense_row(self, i):
+        """ Return row i as a dense vector over the whole vocabulary """
+        vec = np.zeros(self.nwords)
+        word_ids, values = self.row(i)
+        vec[word_ids] = values
+        return vec
+
+    def row_lengths(self):
+        """ Return the number of nonzeros in every row """
+        return np.diff(self.indptr)
+
+    def row_norms(self):
+        """ Return the euclidian length of every row, empty rows get 1 so
+            they can be divided by safely """
+        norms = np.ones(len(self))
+        nonempty = self.row_lengths() > 0
+        if nonempty.any():
+            norms[nonempty] = np.sqrt(np.add.reduceat(np.square(self.values, dtype=np.float64),
+                                                      self.indptr[:-1][nonempty]))
+        return norms
+
+    def row_of_nonzeros(self):
+        """ Return the row index of every nonzero (the expanded indptr) """
+        return np.repeat(np.arange(len(self)), self.row_lengths())
+
+    def slice_rows(self, start, end):
+        """ Return rows start:end as a Corpus sharing this one's arrays """
+        lo, hi = self.indptr[start], self.indptr[end]
+        return Corpus(self.indptr[start:end+1] - lo,
+                      None if self.dense else self.word_ids[lo:hi],
+                      self.values[lo:hi], self.track_ids[start:end], self.words)
+
+    def take(self, rows):
+        """ Return a new Corpus holding copies of the given rows, in order """
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.dense:
+            return Corpus(np.arange(len(rows) + 1, dtype=np.int64) * self.nwords, None,
+                          self.dense_values()[rows], self.track_ids[rows], self.words)
+        lengths = self.row_lengths()[rows]
+        indptr = np.append(0, np.cumsum(lengths))
+        # position of every kept nonzero in the source arrays
+        nonzeros = np.repeat(self.indptr[rows] - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return Corpus(indptr, self.word_ids[nonzeros], self.values[nonzeros],
+                      self.track_ids[rows], self.words)
+
+    def astype(self, dtype):
+        """ Return this corpus with values of dtype, float32 halves their
+            memory and the bandwidth of every pass; this corpus itself if
+            they already are """
+        if self.values.dtype == dtype:
+            return self
+        return Corpus(self.indptr, self._word_ids, self.values.astype(dtype),
+                      self.track_ids, self.words)
+
+    def word_index(self):
+        """ Return a dictionary of word->word_id for the vocabulary """
+        return dict((word, i) for i, word in enumerate(self.words))
+
+    def nbytes(self):
+        word_ids = 0 if self._word_ids is None else self._word_ids.nbytes
+        return (self.indptr.nbytes + word_ids +
+                self.values.nbytes + self.track_ids.nbytes)
+
+    def save(self, path):
+        """ Write the corpus to directory path as flat .npy arrays (offsets,
+            word ids, values and fixed-width track ids) plus a words.txt
+            vocabulary with one word per line.  Corpus.load() maps these
+            files back without parsing or copying them.  A dense corpus
+            has no word ids file, its values are saved as a (tracks,
+            nwords) matrix instead, which marks it as dense. """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, INDPTR_FILE), self.indptr)
+        word_ids_file = os.path.join(path, WORD_IDS_FILE)
+        if self.dense:
+            np.save(os.path.join(path, VALUES_FILE), self.dense_values())
+            if os.path.exists(word_ids_file):
+                os.remove(word_ids_file)
+        else:
+            np.save(word_ids_file, self.word_ids)
+            np.save(os.path.join(path, VALUES_FILE), self.values)
+        np.save(os.path.join(path, TRACK_IDS_FILE), self.track_ids.astype(np.string_))
+        with io.open(os.path.join(path, WORDS_FILE), 'w', encoding='utf-8') as f:
+            for word in self.words:
+                f.write(word + u"\n")
+
+    @staticmethod
+    def nrows(path):
+        """ Return the number of rows of the binary corpus at path """
+        return len(np.load(os.path.join(path, INDPTR_FILE), mmap_mode='r')) - 1
+
+    @staticmethod
+    def load_idf(path):
+        """ Return the idf weights stored with the binary corpus at path,
+            None if there are none """
+        filename = os.path.join(path, IDF_FILE)
+        if not os.path.exists(filename):
+            return None
+        return np.load(filename)
+
+    @staticmethod
+    def splits(path, nparts):
+        """ Return balanced_splits() of the binary corpus at path """
+        return balanced_splits(np.load(os.path.join(path, INDPTR_FILE), mmap_mode='r'),
+                               nparts)
+
+    @classmethod
+    def load(cls, path, start=0, end=None):
+        """ Memory-map rows start:end of the binary corpus written by save().
+
+            Word ids, values and track ids are views into the mapped files,
+            only the (end - start + 1) row offsets are copied to rebase them
+            at zero, so every rank can map just its own shard.
+        """
+        indptr = np.load(os.path.join(path, INDPTR_FILE), mmap_mode='r')
+        values = np.load(os.path.join(path, VALUES_FILE), mmap_mode='r')
+        word_ids = None
+        if values.ndim == 1:
+            word_ids = np.load(os.path.join(path, WORD_IDS_FILE), mmap_mode='r')
+        track_ids = np.load(os.path.join(path, TRACK_IDS_FILE), mmap_mode='r')
+        with io.open(os.path.join(path, WORDS_FILE), encoding='utf-8') as f:
+            words = [line.rstrip(u"\n") for line in f]
+        if end is None:
+            end = len(indptr) - 1
+        return cls(indptr, word_ids, values, track_ids, words).slice_rows(start, end)
+
+    @classmethod
+    def from_rows(cls, rows, words, callback=None):
+        """ Build a corpus from an iterable of (track_id, word_id, tfidf) rows,
+            word_id indexing into the vocabulary words.
+
+            Rows for the same track must be adjacent (ORDER BY track_id).
+            callback, if given, is called with the number of nonzeros read
+            so far every few thousand rows.
+        """
+        indptr = array('l', [0])
+        word_ids = array('i')
+        values = array('d')
+        track_ids = []
+        last_track = None
+        for n, (track_id, word_id, tfidf) in enumerate(rows):
+            if track_id != last_track:
+                if last_track is not None:
+                    indptr.append(len(values))
+                track_ids.append(track_id)
+                last_track = track_id
+            word_ids.append(word_id)
+            values.append(tfidf)
+            if callback is not None and n % 65536 == 0:
+                callback(n)
+        if last_track is not None:
+            indptr.append(len(values))
+        return cls(np.frombuffer(indptr, dtype=np.dtype('l')),
+                   np.frombuffer(word_ids, dtype=np.int32),
+                   np.frombuffer(values, dtype=np.float64),
+                   track_ids, words)
+
+def balanced_splits(indptr, nparts):
+    """ Return nparts + 1 row boundaries that cut the rows of a CSR matrix
+        into contiguous ranges holding about the same number of nonzeros """
+    splits = np.searchsorted(indptr, np.linspace(0, indptr[-1], nparts + 1))
+    splits[0] = 0
+    splits[-1] = len(indptr) - 1
+    return splits
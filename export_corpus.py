@@ -0,0 +1,28 @@
+# export_corpus.py
+# one-time export of mxm_tfidf.db to the memory-mappable binary corpus
+# format read by Corpus.load() (k_means.py / k_means_mpi.py --corpus)
+
+import os
+import sys
+import numpy as np
+from read_tfidf import TFIDFDb
+from corpus import IDF_FILE
+
+MXM_TFIDF = "mxm_tfidf.db"
+MXM_CORPUS = "mxm_tfidf.corpus"
+
+def main(input_db=MXM_TFIDF, output_dir=MXM_CORPUS):
+    dbg("Reading tfidf scores from {}".format(input_db))
+    tfidf = TFIDFDb(input_db)
+    corpus = tfidf.corpus()
+    dbg("Writing {} tracks, {} words, {} nonzeros to {}".format(
+            len(corpus), corpus.nwords, corpus.nnz, output_dir))
+    corpus.save(output_dir)
+    # the idf weights let model files built from this corpus score new tracks
+    np.save(os.path.join(output_dir, IDF_FILE), tfidf.idf())
+
+def dbg(message):
+    sys.stderr.write(message + "\n")
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])
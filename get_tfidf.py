@@ -9,15 +9,31 @@ except ImportError:
     trace = disabled
 
 from math import log
+from itertools import groupby
 import sqlite3
 import sys
+import numpy as np
+
+# number of lyrics rows read and written per executemany() call
+BATCH_ROWS = 200000
+
+# the output database is rebuilt from scratch, so trade durability for speed
+FAST_LOAD_PRAGMAS = [ "PRAGMA journal_mode = OFF",
+                      "PRAGMA synchronous = OFF",
+                      "PRAGMA temp_store = MEMORY",
+                      "PRAGMA cache_size = -262144" ]   # 256MB
 
 class TFIDFCounter(object):
     def __init__(self, dbh):
         self.dbh = dbh
         self.words = {}
+        self.idf = {}
         self.totaldocs = 0
         self._init_totals_for_words()
+        # words are numbered in sorted order, the vocabulary table maps back
+        self.vocabulary = sorted(self.words)
+        self.word_ids = dict((word, i) for i, word in enumerate(self.vocabulary))
+        self.idf_by_id = np.array([self.idf[word] for word in self.vocabulary])
 
     def _init_totals_for_words(self):
         dbg("Initializing document frequency totals...")
@@ -26,37 +42,88 @@ class TFIDFCounter(object):
             self.words[row[0]] = row[1]
         c.execute("SELECT COUNT(DISTINCT(track_id)) from lyrics")
         self.totaldocs = float(c.fetchone()[0])
+        for word, df in self.words.iteritems():
+            self.idf[word] = log ( self.totaldocs / df )
 
-    def calc_tfidf(self, track_id):
+    def calc_batch(self, rows):
+        """ Return (track_id, word_id, tfidf) for a list of (track_id, word, count)
+            rows.  Rows of a track must be adjacent and no track may be split
+            across two batches, otherwise its term frequencies are wrong. """
+        track_ids, words, counts = zip(*rows)
+        counts = np.array(counts, dtype=np.float64)
+        word_ids = np.array([self.word_ids[word] for word in words])
+        tracks = np.array(track_ids)
+        starts = np.flatnonzero(np.append(True, tracks[1:] != tracks[:-1]))
+        lengths = np.diff(np.append(starts, len(tracks)))
+        totals = np.repeat(np.add.reduceat(counts, starts), lengths)
+        tfidf = counts / totals * self.idf_by_id[word_ids]
+        return zip(track_ids, word_ids.tolist(), tfidf.tolist())
 
-        tfidf = []
-        words_in_song = []
-        total_words = 0
+def iter_batches(cursor, batch_rows=BATCH_ROWS):
+    """ Yield lists of (track_id, word, count) rows from a cursor ordered by
+        track_id, each holding whole tracks and roughly batch_rows rows """
+    pending = []
+    while True:
+        rows = cursor.fetchmany(batch_rows)
+        if not rows:
+            break
+        pending.extend(rows)
+        # hold back the last track, its remaining rows may be in the next fetch
+        last_track = pending[-1][0]
+        split = len(pending)
+        while split > 0 and pending[split-1][0] == last_track:
+            split -= 1
+        if split > 0:
+            yield pending[:split]
+            pending = pending[split:]
+    if pending:
+        yield pending
 
-        # get all words in a given song
-        c = self.dbh.cursor()
-        for row in c.execute("SELECT word, count FROM lyrics WHERE track_id = ?", (track_id,)):
-            words_in_song.append(row)
-            total_words += row[1]
-        total_words = float(total_words)
-        # calculate tfidf
-        for word,count in words_in_song:
-            tf = count / total_words
-            idf = log ( self.totaldocs / self.words[word] )
-            tfidf.append((word,tf * idf))
-
-        return tfidf
+def track_lengths(rows):
+    """ Return (track_id, number of rows) of every track in a batch, in order """
+    return [(track_id, sum(1 for row in group))
+            for track_id, group in groupby(rows, lambda row: row[0])]
 
 def init_output_db(dbh):
     # create the tfidf table
     c = dbh.cursor()
+    for pragma in FAST_LOAD_PRAGMAS:
+        c.execute(pragma)
     c.execute("DROP TABLE IF EXISTS tfidf")
+    c.execute("DROP TABLE IF EXISTS vocabulary")
+    c.execute("DROP TABLE IF EXISTS tracks")
+    # words are stored once, tfidf rows refer to them by word_id
+    c.execute('''CREATE TABLE vocabulary
+              (word_id integer primary key,
+               word text unique,
+               df integer,
+               idf real)''')
     c.execute('''CREATE TABLE tfidf
               (track_id text,
-               word text,
+               word_id integer,
                tfidf real)''')
-	c.execute("CREATE INDEX idx_track_id ON tfidf (track_id)")
-	c.execute("CREATE INDEX idx_word ON tfidf (word)")
+    # tfidf rows are written in track_id order, so the rows of track number
+    # row are tfidf rowids offset+1 .. offset+nnz; lets readers balance and
+    # load shards by nonzero count without scanning tfidf
+    c.execute('''CREATE TABLE tracks
+              (row integer primary key,
+               track_id text,
+               nnz integer,
+               offset integer)''')
+    dbh.commit()
+
+def write_vocabulary(dbh, tdc):
+    c = dbh.cursor()
+    c.executemany("INSERT INTO vocabulary VALUES ( ?, ?, ?, ? )",
+                  ((i, word, tdc.words[word], tdc.idf[word])
+                   for i, word in enumerate(tdc.vocabulary)))
+    dbh.commit()
+
+def create_indexes(dbh):
+    # build the indexes once all rows are in, instead of on every insert
+    c = dbh.cursor()
+    c.execute("CREATE INDEX idx_track_id ON tfidf (track_id)")
+    c.execute("CREATE INDEX idx_word_id ON tfidf (word_id)")
     dbh.commit()
 
 def main(input_db="mxm_dataset.db", output_db="mxm_tfidf.db"):
@@ -67,32 +134,35 @@ def main(input_db="mxm_dataset.db", output_db="mxm_tfidf.db"):
     out = sqlite3.connect(output_db)
 
     dbg("Creating output tables in {}".format(output_db))
-    init_output_db(out) 
+    init_output_db(out)
     tdc = TFIDFCounter(mxm)
+    write_vocabulary(out, tdc)
 
-    trace()
-    # calculate the tfidf for all documents
+    # calculate the tfidf for all documents in one ordered scan of lyrics
     dbg("Begin calculating TFIDF...")
     compl = 0
-    tenpcnt = int(tdc.totaldocs / 100)
     c = mxm.cursor()
     d = out.cursor()
+    offset = 0
     query = "INSERT INTO tfidf VALUES ( ?, ?, ? )"
-    for row in c.execute ("SELECT DISTINCT(track_id) FROM lyrics"):
-        track_id = row[0]
-        for word, tfidf in tdc.calc_tfidf(track_id):
-            d.execute(query, (track_id, word, tfidf))
-        compl += 1
-        if (compl % tenpcnt == 0):
-            print ("{:.2%} complete".format(compl / tdc.totaldocs))
+    c.execute("SELECT track_id, word, count FROM lyrics ORDER BY track_id")
+    for rows in iter_batches(c):
+        d.executemany(query, tdc.calc_batch(rows))
+        tracks = []
+        for track_id, nnz in track_lengths(rows):
+            tracks.append((compl, track_id, nnz, offset))
+            compl += 1
+            offset += nnz
+        d.executemany("INSERT INTO tracks VALUES ( ?, ?, ?, ? )", tracks)
+        print ("{:.2%} complete".format(compl / tdc.totaldocs))
     out.commit()
+
+    dbg("Creating indexes...")
+    create_indexes(out)
     print ("Processed {} tracks".format(compl))
 
 def dbg(message):
     sys.stderr.write(message + "\n")
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        main(input_db=sys.argv[1])
-    elif len(sys.argv) > 2:
-        main(input_db=sys.argv[1], output_db=sys.argv[2])
+    main(*sys.argv[1:3])
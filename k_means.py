@@ -2,10 +2,22 @@
 # calculate k-means over the lyric database
 # using tfidf scaling + cosine similarity
 
+import os
 import sys
-import sqlite3
+import argparse
 from math import sqrt
 import numpy as np
+from read_tfidf import TFIDFDb
+from corpus import Corpus, PROJECTION_FILE
+from assign import assign, cluster_sums, cluster_means, add_moved_sums, PrunedAssigner
+from postings import PostingsAssigner, drift
+from convergence import Convergence, centroid_shift
+from seeding import random_rows, kmeans_plusplus
+from minibatch import minibatch_kmeans
+from parallel import PoolEngine
+from summary import ClusterSummary, word_counts
+from model import Model, load_idf
+from checkpoint import Checkpoint, save_checkpoint, load_checkpoint, vocabulary_hash
 
 trace = None
 try:
@@ -17,12 +29,19 @@ except ImportError:
 MXM_DB = "mxm_dataset.db"
 MXM_TFIDF = "mxm_tfidf_small.db"
 
+# with --incremental, rebuild the centroid sums from scratch this often
+REFRESH_PASSES = 10
+
 tfidf = None
+corpus = None
+words = [ ]
+all_tracks = None
 num_means = 6
 total_docs = 0
 modpct = 1
 
 centroids = [ ]
+rng = None
 
 def bow_av_merge (src, dest, cursz):
     for key,val in src.iteritems():
@@ -51,26 +70,14 @@ def cosine (t1, t2):
 #        trace()
     return result
 
-def get_vectory (track_id):
-    c = tfidf.cursor()
-    c.execute("SELECT word, tfidf FROM tfidf WHERE track_id = ?", (track_id,))
-    return dict(c.fetchall())
-
-def make_sense_of_cluster(cluster):
-    # fetch the tfidf scores for every song in the cluster to determine
-    # the top 30 (hopefully) word-genre defining tokens
-
-    c = tfidf.cursor()
-    query = """SELECT word, SUM(tfidf) AS s FROM tfidf 
-               WHERE track_id IN ( '{}' ) 
-               GROUP BY word ORDER BY s DESC LIMIT 30""".format("','".join(cluster))
-    c.execute(query)
-    return c.fetchall()
-
-def update_clustering(npass, nproc, ndocs, last_track, last_cluster):
-    # move up two lines and spit out the pass number, and percentage done
-    update_text("Pass# {:3}       {}  --->  {}\033[K".format(npass, last_track, last_cluster))
-    update_progress(nproc,ndocs)
+def make_sense_of_clusters(clusters):
+    # the top (hopefully) word-genre defining tokens of every cluster,
+    # summed from the cached corpus, see summary.py
+    labels = np.empty(len(corpus), dtype=np.int32)
+    for i, cluster in enumerate(clusters):
+        labels[cluster] = i
+    sums, counts = cluster_sums(corpus, labels, len(clusters))
+    return ClusterSummary(sums, counts, word_counts(corpus, labels, len(clusters)))
 
 def update_text(message):
     # move up two lines and spit out the pass number, and percentage done
@@ -85,98 +92,185 @@ def update_progress(comp, total, length=40):
                                                 length=length))
     sys.stderr.write("\033[1B\r")
 
-def init():
-    global tfidf, centroids, total_docs, modpct
-    tfidf = sqlite3.connect(MXM_TFIDF)
+def init(corpus_path=None, seed=None, minibatch=False):
+    global tfidf, corpus, centroids, total_docs, modpct, rng, words, all_tracks
 
     dbg("Beginning k-means clustering with K={}".format(num_means))
 
     dbg("Initializing values...")
 
-    c = tfidf.cursor()
-    c.execute("SELECT COUNT(DISTINCT(track_id)) FROM tfidf")
-    total_docs = c.fetchone()[0]
+    rng = np.random.RandomState(seed)
+    if corpus_path is not None:
+        corpus = Corpus.load(corpus_path)
+        words = corpus.words
+        total_docs = len(corpus)
+    elif minibatch:
+        # leave the tracks in sqlite, batches are fetched as they are drawn
+        tfidf = TFIDFDb(MXM_TFIDF)
+        words = tfidf.vocabulary()
+        all_tracks = np.array(tfidf.track_ids())
+        total_docs = len(all_tracks)
+    else:
+        update_text("Caching tracks...")
+        tfidf = TFIDFDb(MXM_TFIDF)
+        corpus = tfidf.corpus()
+        words = corpus.words
+        total_docs = len(corpus)
     modpct = total_docs / 2000
     if (modpct < 1): modpct = 1
 
-    update_text("Picking random centroids K={}".format(num_means))
-    # find some random centroids
-    for t_id in c.execute("SELECT DISTINCT(track_id) FROM tfidf ORDER BY RANDOM() LIMIT {}".format(num_means)): 
-        centroids.append(get_vectory(t_id[0]))
-        update_progress(len(centroids),num_means) 
-
-def main():
+def pick_centroids(method="kmeans++"):
     global centroids
-    npass = 0
-    clusters = None
-    cluster_counts = [0] * num_means
-    old_cluster_counts = None
-
-    c = tfidf.cursor()
-
-    update_text("Caching tracks, n={}".format(total_docs))
-    c.execute("SELECT DISTINCT(track_id) FROM tfidf")
-    all_tracks = c.fetchall()
-
-    update_text("Set up is complete, starting k-means. modpct = {}".format(modpct))
+    update_text("Picking initial centroids K={} ({})".format(num_means, method))
+    if method == "kmeans++":
+        centroids = kmeans_plusplus(corpus, num_means, rng,
+                callback=lambda n: update_progress(n, num_means))
+    else:
+        centroids = random_rows(corpus, num_means, rng)
+    update_progress(num_means,num_means)
+
+def main(convergence=None, prune=False, processes=1, incremental=False,
+         checkpoint_file=None, params=None, resume_from=None, postings=None):
+    """ Run k-means passes until convergence says to stop.  With
+        checkpoint_file a checkpoint is written after every pass, params are
+        stored in it.  resume_from is a Checkpoint to continue from, its
+        centroids must already be in place.  postings is the number of words
+        kept per centroid for the approximate assignment of postings.py. """
+    global centroids, corpus
+    if convergence is None:
+        convergence = Convergence()
+    labels = None
+    sums = None
+    if resume_from is not None:
+        labels = resume_from.labels_for(corpus.track_ids)
+        missing = np.count_nonzero(labels < 0)
+        if missing * 2 > total_docs:
+            dbg("Warning: {} of {} tracks are not in the checkpoint, was it written "
+                "for another corpus?".format(missing, total_docs))
+        convergence.restore(resume_from.npass, resume_from.objective)
+    vocabulary = vocabulary_hash(words) if checkpoint_file is not None else None
+    row_norms = corpus.row_norms()
+    assigner = None
+    engine = None
+    if prune:
+        assigner = PrunedAssigner(corpus, row_norms)
+    elif postings:
+        assigner = PostingsAssigner(corpus, row_norms, postings)
+    elif processes > 1:
+        update_text("Starting {} worker processes".format(processes))
+        engine = PoolEngine(corpus, num_means, processes, row_norms)
+        # the workers share the engine's copy, keep only that one
+        corpus = engine.corpus
+
+    update_text("Set up is complete, starting k-means. modpct = {} nnz={}".format(modpct, corpus.nnz))
 
     # keep going until we converge
-    while tuple(cluster_counts) != old_cluster_counts:
-        print("{} != {}\n\n".format(cluster_counts, old_cluster_counts))
+    while True:
         update_progress(0,total_docs)
-        nprocs = 0
-        old_cluster_counts  = tuple(cluster_counts)
-        cluster_counts = [0] * num_means
-        clusters = [[] for x in xrange(0,num_means)]
-        new_centroids = [{} for x in xrange(0,num_means)]
-
-        # for each track, find nearest cluster
-        for row in all_tracks:
-            t_id = row[0]
-            trackVec = get_vectory(t_id)
-            similarities = [float('inf')] * num_means
-            for i,centr  in enumerate(centroids):
-                similarities[i] = cosine (trackVec, centr)
-            mindex = reduce(lambda x, y: x if x[1] > y[1] else y, enumerate(similarities))[0]
-            clusters[mindex].append(t_id)
-#            bow_av_merge(trackVec, new_centroids[mindex], cluster_counts[mindex])
-            cluster_counts[mindex] += 1
-            nprocs += 1
-            if nprocs % modpct == 0:
-                update_clustering(npass, nprocs, total_docs, t_id, mindex)
-
-#        centroids = new_centroids
+        old_labels = labels
+
+        # find the nearest cluster for every track, a block at a time
+        update_text("Pass# {:3}       assigning {} tracks".format(convergence.npass, total_docs))
+        progress = lambda nprocs: update_progress(nprocs, total_docs)
+        if engine is not None:
+            labels, similarities, sums, counts = engine.run_pass(centroids, progress)
+        elif assigner is not None:
+            labels, similarities = assigner.assign(centroids, progress)
+        else:
+            labels, similarities = assign(corpus, centroids, row_norms, progress)
+        cluster_counts = np.bincount(labels, minlength=num_means).tolist()
+        if old_labels is None:
+            nchanged = total_docs
+        else:
+            nchanged = np.count_nonzero(labels != old_labels)
+
         update_text("Recomputing centroids...{}".format(repr(cluster_counts)))
         
-        for cluster_id in range(num_means):
-            for t_id in clusters[cluster_id]:
-                query = """SELECT word, AVG(tfidf) FROM tfidf 
-                           WHERE track_id IN ( '{}' ) 
-                           GROUP BY word""".format("','".join(clusters[cluster_id]))
-                c.execute(query)
-                centroids[cluster_id] = dict(c.fetchall())
-                update_progress(cluster_id,num_means)
-
-#            if centroids[cluster_id] != new_centroids[cluster_id]:
-#                trace()
-
-        npass += 1
-
+        # with a pool engine the workers already summed their tracks
+        if engine is None:
+            if (incremental and sums is not None
+                    and convergence.npass % REFRESH_PASSES != 0):
+                # only move the tracks that changed cluster, every REFRESH_PASSES
+                # passes rebuild the sums from scratch to shed rounding error
+                add_moved_sums(sums, counts, corpus, old_labels, labels)
+            else:
+                sums, counts = cluster_sums(corpus, labels, num_means)
+        old_centroids, centroids = centroids, cluster_means(sums, counts, centroids)
+        update_progress(1,1)
+
+        done = convergence.update(nchanged, total_docs, np.sum(similarities),
+                                  centroid_shift(old_centroids, centroids))
+        dbg(convergence.status())
+        if checkpoint_file is not None:
+            save_checkpoint(checkpoint_file, Checkpoint(centroids, corpus.track_ids,
+                    labels, convergence.npass, convergence.objective,
+                    rng.get_state(), params, vocabulary))
+        if postings:
+            dbg("Scored {:.2%} of the dense products".format(
+                    assigner.computed / float(max(assigner.possible, 1))))
+        elif assigner is not None:
+            dbg("Scored {:.2%} of track/centroid pairs".format(
+                    assigner.computed / float(max(assigner.possible, 1))))
+        if done:
+            break
+
+    if engine is not None:
+        engine.close()
+    dbg("Converged after {} passes: {}".format(convergence.npass, convergence.reason))
+    if postings:
+        # the last labels came from the centroids before the final update
+        ndiffer, lost, max_lost = drift(corpus, old_centroids, labels, row_norms)
+        dbg("Postings drift: {} of {} tracks ({:.2%}) off their exact cluster, "
+            "similarity lost mean {:.5f} max {:.5f}".format(ndiffer, total_docs,
+                ndiffer / float(max(total_docs, 1)), lost / max(total_docs, 1), max_lost))
+    clusters = [np.flatnonzero(labels == i) for i in xrange(num_means)]
     return clusters, cluster_counts
 
+def draw_batch(n):
+    """ Return a Corpus of n random tracks, every track if there are fewer,
+        from the mapped corpus if there is one, otherwise straight from
+        sqlite """
+    n = min(n, total_docs)
+    if corpus is not None:
+        return corpus.take(np.sort(rng.choice(len(corpus), n, replace=False)))
+    return tfidf.corpus(rng.choice(all_tracks, n, replace=False).tolist(), words)
+
+def main_minibatch(batch_size, iterations, full_pass=False, initial=None):
+    """ mini-batch k-means, see minibatch.py.  Only with full_pass are all
+        tracks assigned once at the end, otherwise clusters is None and the
+        counts are the sampled tracks each cluster absorbed.  initial are
+        starting centroids, by default they are seeded from a first batch """
+    global centroids, corpus
+    batch_size = min(batch_size, total_docs)
+
+    def report(i, similarity):
+        update_text("Batch# {:4}   mean similarity {:.4f}".format(i, similarity))
+        update_progress(i, iterations)
+    centroids, counts = minibatch_kmeans(draw_batch, num_means, rng, batch_size,
+                                         iterations, initial, callback=report)
+    if not full_pass:
+        return None, counts.astype(int).tolist()
+
+    if corpus is None:
+        update_text("Caching tracks...")
+        corpus = tfidf.corpus(words=words)
+    update_text("Assigning {} tracks".format(total_docs))
+    labels, similarities = assign(corpus, centroids, callback=lambda nprocs: update_progress(nprocs, total_docs))
+    dbg("Objective after the full pass: {:.6g}".format(np.sum(similarities)))
+    clusters = [np.flatnonzero(labels == i) for i in xrange(num_means)]
+    return clusters, np.bincount(labels, minlength=num_means).tolist()
+
 def dump_centroids(centroids, cluster_counts):
     for i, centroid in enumerate(centroids):
         print("Cluster {} ({})\n{}".format(i, cluster_counts[i], "="*31))
-        words = centroid.items()
-        words.sort(key=lambda x: x[1], reverse=True)
-        for word, tfidf in words[:30]:
-            print("{:20} {:10f}".format(word.encode('utf-8'), tfidf))
+        for word_id in np.argsort(centroid)[::-1][:30]:
+            print("{:20} {:10f}".format(words[word_id].encode('utf-8'), centroid[word_id]))
         print
 
 def dump_clusters(clusters, cluster_counts):
     for i, cluster in enumerate(clusters):
         print("Cluster {} ({})\n{}".format(i, cluster_counts[i], "="*31))
-        for t_id in cluster:
+        for t_id in corpus.track_ids[cluster]:
             print(t_id)
         print
 
@@ -184,13 +278,87 @@ def dbg(message):
     sys.stderr.write(message + "\n")
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
+    parser = argparse.ArgumentParser(description="sequential k-means over the tfidf database")
+    parser.add_argument("k", type=int, nargs="?", default=num_means,
+                        help="number of clusters (default {})".format(num_means))
+    parser.add_argument("--corpus",
+                        help="binary corpus written by export_corpus.py, "
+                             "read instead of {}".format(MXM_TFIDF))
+    parser.add_argument("--init", choices=["random", "kmeans++"], default="kmeans++",
+                        help="how to pick the initial centroids (default kmeans++)")
+    parser.add_argument("--seed", type=int,
+                        help="random seed, makes runs repeatable")
+    parser.add_argument("--minibatch", type=int, metavar="BATCH_SIZE",
+                        help="run mini-batch k-means with batches of this many tracks")
+    parser.add_argument("--batch-iterations", type=int, default=100,
+                        help="number of mini-batches (default 100)")
+    parser.add_argument("--full-pass", action="store_true",
+                        help="after mini-batch k-means, assign every track once")
+    parser.add_argument("--prune", action="store_true",
+                        help="skip centroids that cannot win using distance bounds "
+                             "(rarely pays off on sparse tfidf, see assign.PrunedAssigner)")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the corpus (default 1, "
+                             "not combined with --prune, --postings or --incremental)")
+    parser.add_argument("--postings", type=int, metavar="WORDS",
+                        help="approximate assignment over centroids truncated to their "
+                             "top WORDS words, kept as an inverted index; the drift from "
+                             "exact assignment is reported at the end")
+    parser.add_argument("--incremental", action="store_true",
+                        help="update centroid sums with only the tracks that changed cluster")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="write a checkpoint to FILE after every pass")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the --checkpoint FILE of an earlier run")
+    parser.add_argument("--summary", type=int, metavar="N",
+                        help="also print the top N and the N most distinctive "
+                             "words of every cluster")
+    parser.add_argument("--model", metavar="FILE",
+                        help="save the centroids, vocabulary and idf weights to FILE "
+                             "for classifying new tracks (see track_lookup.py)")
+    Convergence.add_arguments(parser)
+    args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume needs --checkpoint FILE")
+    if (args.model and args.corpus is not None and
+            os.path.exists(os.path.join(args.corpus, PROJECTION_FILE))):
+        parser.error("a model of a projected corpus needs the original space, "
+                     "use k_means_mpi.py --relabel")
+    if args.postings is not None and (args.prune or args.processes > 1):
+        parser.error("--postings is not combined with --prune or --processes")
+    if args.processes > 1 and (args.prune or args.incremental):
+        parser.error("--processes is not combined with --prune or --incremental")
+    if args.minibatch is not None and (args.minibatch < 1 or args.batch_iterations < 1):
+        parser.error("--minibatch and --batch-iterations must be at least 1")
+    num_means = args.k
+    init(args.corpus, args.seed, minibatch=args.minibatch is not None)
+    resume_from = None
+    if args.resume:
+        resume_from = load_checkpoint(args.checkpoint)
         try:
-            num_means = int(sys.argv[1])
-        except ValueError:
-            dbg("Error, argument 1 must be an integer")
-    init()
-    clusters, cluster_counts = main()
+            resume_from.check_vocabulary(words)
+        except ValueError as e:
+            parser.error("cannot resume from {}: {}".format(args.checkpoint, e))
+        centroids = resume_from.centroids
+        num_means = len(centroids)
+        if resume_from.rng_state is not None:
+            rng.set_state(resume_from.rng_state)
+        dbg("Resuming after pass {} with K={}".format(resume_from.npass, num_means))
+    elif args.minibatch is None:
+        pick_centroids(args.init)   # minibatch_kmeans() seeds from its first batch
+    if args.minibatch is not None:
+        clusters, cluster_counts = main_minibatch(args.minibatch, args.batch_iterations,
+                args.full_pass, resume_from.centroids if resume_from else None)
+    else:
+        clusters, cluster_counts = main(Convergence.from_args(args), args.prune,
+                                       args.processes, args.incremental,
+                                       args.checkpoint, vars(args), resume_from,
+                                       args.postings)
     dbg("Process complete, cluster counts={}".format(cluster_counts))
-    dump_centroids()
-    dump_clusters(clusters)
+    if args.model:
+        Model(centroids, words, load_idf(args.corpus, MXM_TFIDF), vars(args)).save(args.model)
+    dump_centroids(centroids, cluster_counts)
+    if clusters is not None:
+        dump_clusters(clusters, cluster_counts)
+        if args.summary:
+            print(make_sense_of_clusters(clusters).report(words, args.summary))
@@ -2,14 +2,27 @@
 # calculate k-means over the lyric database
 # using tfidf scaling + cosine similarity
 
-import sys
-import sqlite3
-from math import sqrt, ceil
+import os
+import json
+import argparse
+import traceback
+from math import sqrt
 from time import sleep
-from random import random
+import numpy as np
 from mpi4py import MPI
-from k_means import cosine
-from progress import ProgressManager
+from assign import (assign, cluster_sums, cluster_means, add_moved_sums, PrunedAssigner,
+                    assigned_similarities, normalize_centroids)
+from postings import PostingsAssigner, drift
+from convergence import Convergence, centroid_shift
+from read_tfidf import TFIDFDb
+from corpus import Corpus, balanced_splits, PROJECTION_FILE
+from seeding import kmeans_parallel, random_centroids
+from model import Model, load_idf
+from checkpoint import Checkpoint, save_checkpoint, load_checkpoint, vocabulary_hash
+from writer import BackgroundWriter
+from summary import ClusterSummary, word_counts
+from progress import ProgressChannel, make_sink, SINKS
+from timing import Timings, write_report, start_profile, stop_profile
 
 #trace = None
 #try:
@@ -21,264 +34,470 @@ from progress import ProgressManager
 MXM_DB = "mxm_dataset.db"
 MXM_TFIDF = "mxm_tfidf.db"
 
+# sampling rounds of k-means|| seeding
+SEED_ROUNDS = 5
+
+# with --incremental, rebuild the centroid sums from scratch this often
+REFRESH_PASSES = 10
+
 tfidf = None
 num_means = 6
 total_docs = 0
 modpct = 1
 
 centroids = [ ]
-track_cache = [ ]
+track_cache = None
+track_norms = None
+words = [ ]
+# dtype of the corpus values, the centroids and the reduction buffer; sums
+# that build up over passes are kept in float64 either way
+precision = np.float64
+# the float64 corpus, kept only to validate a float32 run against
+exact_cache = None
+
+rng = None
 
 progressmgr = None
+timings = Timings()
 myrank = None
 size = None
 comm = None
 
-def build_cache(tracks):
-    c = tfidf.cursor()
-    track_table = " ( '{}' ) ".format("','".join(tracks))
-    c.execute("SELECT COUNT(word) FROM tfidf WHERE track_id IN {}".format(track_table))
-    nrecs = c.fetchone()[0]
-    c.execute("SELECT track_id, word, tfidf FROM tfidf WHERE track_id IN {}".format(track_table))
-    update_text("Caching {} words in {} songs".format(nrecs, len(tracks)))
-    update_progress(0,nrecs)
-    result = {}
-    for i in xrange(nrecs):
-        row = c.fetchone()
-        if row[0] not in result:
-            result[row[0]] = {}
-        result[row[0]][row[1]] = row[2]
-        if i % modpct == 0:
-            update_progress(i+1, nrecs)
-    update_progress(nrecs,nrecs)
-
-    return result
-
-def get_vector (track_id):
-    c = tfidf.cursor()
-    c.execute("SELECT word, tfidf FROM tfidf WHERE track_id = ?", (track_id,))
-    return dict(c.fetchall())
-
-def cluster_mean(tracks, callback=None):
-    sofar = 0
-    ntracks = len(tracks)
-    cluster_totals = {}
-    for t_id in tracks:
-        vec = track_cache[t_id]
-        for word, tfidf in vec.items():
-            if word not in cluster_totals:
-                cluster_totals[word] = 0
-            cluster_totals[word] += tfidf
-        if callback is not None:
-            sofar += 1
-            if sofar % modpct == 0:
-                callback(sofar)
-                sofar = 0
-    if cluster_totals:
-        for word in cluster_totals:
-            cluster_totals[word] /= ntracks
-    return cluster_totals
-def vector_mean(vectors, limit=1000):
-    nvecs = len(vectors)
-    cluster_totals = {}
-    for vec in vectors:
-        for word, tfidf in vec.items():
-            if word not in cluster_totals:
-                cluster_totals[word] = 0
-            cluster_totals[word] += tfidf
-    if cluster_totals:
-        for word in cluster_totals:
-            cluster_totals[word] /= nvecs
-    avtfidfs = cluster_totals.values()
-    avtfidfs.sort(reverse=True)
-    if len(avtfidfs) > limit:
-        cutoff = avtfidfs[limit]
-        for word in cluster_totals.keys():
-            if cluster_totals[word] < cutoff:
-                del cluster_totals[word]
-    return cluster_totals
-
-def update_clustering(npass, nproc, ndocs, last_track, last_cluster):
-    update_text("Pass# {:3}       {}  --->  {}".format(npass, last_track, last_cluster))
-    update_progress(nproc,ndocs)
-
 def update_text(message):
     progressmgr.update_text(message)
 
 def update_progress(comp, total, length=40):
     progressmgr.update_progress(comp, total)
 
-def init():
-    global tfidf, centroids, total_docs, modpct, track_cache
-    tfidf = sqlite3.connect(MXM_TFIDF)
+def init_from_corpus(corpus_path):
+    """ Map this rank's share of a binary corpus (see export_corpus.py).
+        Every rank opens its own rows, nothing is sent around """
+    global total_docs, modpct, track_cache, words
 
-    rcentroids = []
-
-    if myrank == 0:
-        update_text("Counting tracks...")
-        update_progress(0,1)
+    update_text("Mapping corpus {}".format(corpus_path))
+    update_progress(0,1)
+    total_docs = Corpus.nrows(corpus_path)
+    modpct = total_docs / 2000
+    if (modpct < 1): modpct = 1
+    # ranks get about the same number of nonzeros, not of tracks
+    splits = Corpus.splits(corpus_path, size)
+    track_cache = Corpus.load(corpus_path, splits[myrank], splits[myrank+1])
+    words = track_cache.words
 
-        c = tfidf.cursor()
-        c.execute("SELECT COUNT(DISTINCT(track_id)) FROM tfidf")
-        total_docs = c.fetchone()[0]
-        modpct = total_docs / 2000
-        if (modpct < 1): modpct = 1
+    update_progress(1,1)
 
-        update_text("Picking random centroids K={}".format(num_means))
-        update_progress(1,2)
+def init_from_db():
+    """ Every rank reads the track lengths of mxm_tfidf.db, splits the
+        tracks into ranges holding about the same number of nonzeros and
+        caches the tfidf scores of its own range, without rank 0 """
+    global tfidf, total_docs, modpct, track_cache, words
+    tfidf = TFIDFDb(MXM_TFIDF)
 
-        # find some random centroids
-        for t_id in c.execute("SELECT DISTINCT(track_id) FROM tfidf ORDER BY RANDOM() LIMIT {}".format(num_means)): 
-            rcentroids.append(get_vector(t_id[0]))
-            update_progress(len(rcentroids),num_means) 
+    update_text("Reading track lengths...")
+    update_progress(0,1)
+    lengths = tfidf.track_lengths()
+    total_docs = len(lengths)
+    modpct = total_docs / 2000
+    if (modpct < 1): modpct = 1
+    # word ids are fixed by the database, every rank reads the same list
+    words = tfidf.vocabulary()
+    splits = balanced_splits(np.append(0, np.cumsum(lengths)), size)
+    start, end = splits[myrank], splits[myrank+1]
+    nrecs = int(lengths[start:end].sum())
+    update_text("Caching {} words in {} songs".format(nrecs, end - start))
+    update_progress(0,nrecs)
+    track_cache = tfidf.corpus_rows(start, end, words,
+                                    lambda i: update_progress(i+1, nrecs))
+    update_progress(nrecs,nrecs)
 
-        update_text("Transmitting initial values".format(num_means))
-        update_progress(2,2)
-    else:
-        update_text("Waiting for initial centroids...")
-        update_progress(0,1)
-    total_docs = comm.bcast(total_docs, 0)
-    modpct = comm.bcast(modpct, 0)
-    centroids = comm.bcast(rcentroids, root=0)
+def init(corpus_path=None, keep_exact=False):
+    """ Load this rank's tracks in precision.  With keep_exact the float64
+        corpus is kept as well, for validate_precision() """
+    global track_cache, track_norms, exact_cache
+    with timings.phase("load"):
+        if corpus_path is not None:
+            init_from_corpus(corpus_path)
+        else:
+            init_from_db()
+        # computed once, shared by every seeding and run on this corpus
+        track_norms = track_cache.row_norms()
+        if keep_exact:
+            exact_cache = track_cache
+        track_cache = track_cache.astype(precision)
+
+def pick_centroids(method="kmeans||"):
+    global centroids
+    update_text("Picking initial centroids K={} ({})".format(num_means, method))
+    update_progress(0,1)
+    with timings.phase("seed"):
+        if method == "kmeans||":
+            centroids = kmeans_parallel(comm, track_cache, num_means, rng,
+                    rounds=SEED_ROUNDS, row_norms=track_norms,
+                    callback=lambda r, n: update_progress(r, SEED_ROUNDS))
+        else:
+            centroids = random_centroids(comm, track_cache, num_means, rng)
+        centroids = centroids.astype(precision)
     update_progress(1,1)
 
-    requests = []
-    if myrank == 0:
-        c = tfidf.cursor()
-        c.execute("SELECT DISTINCT(track_id) FROM tfidf")
-        chunksz = int(ceil(total_docs / float(size)))
-        update_text("Caching track_ids, chunksz={}".format(chunksz))
-        update_progress(0,size)
-        alltracks = [x[0] for x in c.fetchmany(chunksz)]
-        for r in xrange(1,size):
-            chunk = [x[0] for x in c.fetchmany(chunksz)]
-            requests.append(comm.isend(chunk, dest=r, tag=1))
-            update_progress(r+1,size)
-    else:
-        update_text("Waiting for tracks...")
-        alltracks = comm.recv(source=0, tag=1)
-    track_cache = build_cache(alltracks)
-
-    if myrank == 0:
-        MPI.Request.waitall(requests)
-
     comm.Barrier()
 
-def main(centroid_file, cluster_file):
+def gather_track_ids():
+    """ Return the track ids of all ranks in rank order on rank 0 along
+        with the number of tracks of every rank, None elsewhere """
+    parts = comm.gather(track_cache.track_ids, root=0)
+    if myrank != 0:
+        return None, None
+    return np.concatenate(parts), np.array([len(part) for part in parts])
+
+def gather_labels(labels, rank_counts):
+    """ Gatherv this rank's int32 labels into one array on rank 0 """
+    labels = np.ascontiguousarray(labels, dtype=np.int32)
+    recvbuf = None
+    if myrank == 0:
+        all_labels = np.empty(rank_counts.sum(), dtype=np.int32)
+        displs = np.concatenate([[0], np.cumsum(rank_counts)[:-1]])
+        recvbuf = [all_labels, (rank_counts, displs), MPI.INT]
+    comm.Gatherv([labels, MPI.INT], recvbuf, root=0)
+    return all_labels if myrank == 0 else None
+
+def write_output(track_ids, labels, centroids, cluster_counts, npass,
+                 centroid_file, cluster_file):
+    """ Runs on the writer thread of rank 0 """
+    order = np.argsort(labels, kind="mergesort")
+    bounds = np.searchsorted(labels[order], np.arange(1, len(centroids)))
+    clusters = np.split(track_ids[order], bounds)
+    dump_clusters(clusters, cluster_counts, cluster_file, npass)
+    dump_centroids(centroids, cluster_counts, centroid_file, npass)
+
+def write_summary(summary, filename, n, npass):
+    """ Runs on the writer thread of rank 0 """
+    with open(filename, 'w') as f:
+        f.write("Writing output at pass {}\n\n".format(npass))
+        f.write(summary.report(words, n))
+
+def abort_on_error(func, *args):
+    """ Call func(*args) and abort the whole job if it raises, the other
+        ranks would otherwise wait for rank 0 forever """
+    try:
+        func(*args)
+    except Exception:
+        traceback.print_exc()
+        comm.Abort(1)
+
+def main(centroid_file, cluster_file, convergence=None, prune=False,
+         incremental=False, checkpoint_file=None, params=None, resume_from=None,
+         output_every=1, summary_file=None, summary_words=30, postings=None):
+    """ Run k-means passes until convergence says to stop.  Every
+        output_every passes and after the last one the labels are gathered
+        on rank 0, which writes the output files, and with checkpoint_file
+        a checkpoint holding params, on a background thread.  With
+        summary_file the top and most distinctive summary_words words of
+        every cluster are written there as well.  With output_every None
+        nothing is gathered or written.  resume_from is a Checkpoint to
+        continue from, its centroids must already be in place.  postings is
+        the number of words kept per centroid for the approximate assignment
+        of postings.py, its drift from exact assignment is reported at the
+        end.  Returns this rank's labels and the cluster sizes. """
     global centroids
+    if convergence is None:
+        convergence = Convergence()
     npass = 0
-    clusters = None
-    cluster_counts = [0] * num_means
-    old_cluster_counts = None
+    labels = None
     ntracks = len(track_cache)
+    if resume_from is not None:
+        # labels are keyed by track id, so the ranks may be split differently
+        labels = resume_from.labels_for(track_cache.track_ids)
+        missing = comm.allreduce(int(np.count_nonzero(labels < 0)), op=MPI.SUM)
+        if missing * 2 > total_docs:
+            update_text("Warning: {} of {} tracks are not in the checkpoint, was it "
+                        "written for another corpus?".format(missing, total_docs))
+        npass = resume_from.npass
+        convergence.restore(resume_from.npass, resume_from.objective)
+    writing = output_every is not None
+    # rank 0 learns every track id once, afterwards only labels are sent
+    if writing:
+        with timings.phase("gather", track_cache.track_ids.nbytes):
+            all_track_ids, rank_counts = gather_track_ids()
+    writer = None
+    vocabulary = None
+    if writing and myrank == 0:
+        writer = BackgroundWriter()
+        if checkpoint_file is not None:
+            vocabulary = vocabulary_hash(words)
+    row_norms = track_norms
+    assigner = None
+    if prune:
+        assigner = PrunedAssigner(track_cache, row_norms)
+    elif postings:
+        assigner = PostingsAssigner(track_cache, row_norms, postings)
+    # per-cluster tfidf sums with the cluster size in the last column, sent
+    # in precision
+    reduction = np.empty((num_means, len(words) + 1), dtype=precision)
+    # global running totals of the same, for incremental updates
+    totals = np.empty(reduction.shape)
+    # number of changed labels and the objective, summed over all ranks
+    pass_stats = np.empty(2)
+    have_totals = False
 
     update_text("Set up is complete, starting k-means. modpct = {} ntracks={}".format(modpct,ntracks))
 
     # keep going until we converge
-    while tuple(cluster_counts) != old_cluster_counts:
+    while True:
+        timings.begin_pass()
         update_progress(0,ntracks)
-        nprocs = 0
-        old_cluster_counts  = tuple(cluster_counts)
-        cluster_counts = [0] * num_means
-        clusters = [[] for x in xrange(0,num_means)]
-        new_centroids = [{} for x in xrange(0,num_means)]
-
-        # for each track, find nearest cluster
-        for t_id, vec in track_cache.iteritems():
-            similarities = [float('inf')] * num_means
-            for i,centr  in enumerate(centroids):
-                similarities[i] = cosine (vec, centr)
-            mindex = reduce(lambda x, y: x if x[1] > y[1] else y, enumerate(similarities))[0]
-            clusters[mindex].append(t_id)
-            cluster_counts[mindex] += 1
-            nprocs += 1
-            if nprocs % modpct == 0:
-                update_clustering(npass, nprocs, ntracks, t_id, mindex)
+        old_labels = labels
+
+        # find the nearest cluster for every track, a block at a time
+        update_text("Pass# {:3}       assigning {} tracks".format(npass, ntracks))
+        progress = lambda nprocs: update_progress(nprocs, ntracks)
+        with timings.phase("assign"):
+            if assigner is not None:
+                labels, similarities = assigner.assign(centroids, progress)
+            else:
+                labels, similarities = assign(track_cache, centroids, row_norms, progress)
+        if postings:
+            update_text("Scored {:.2%} of the dense products".format(
+                    assigner.computed / float(max(assigner.possible, 1))))
+        elif assigner is not None:
+            update_text("Scored {:.2%} of track/centroid pairs".format(
+                    assigner.computed / float(max(assigner.possible, 1))))
+        if old_labels is None:
+            pass_stats[0] = ntracks
+        else:
+            pass_stats[0] = np.count_nonzero(labels != old_labels)
+        pass_stats[1] = np.sum(similarities)
 
         update_text("Recomputing centroids...")
-        
-        nprocs = [0]
-        def cb(sofar):
-            nprocs[0] += sofar     # i <3 lexical scoping
-            update_progress(nprocs[0], ntracks)
-        for cluster_id in range(num_means):
-            centroids[cluster_id] = cluster_mean(clusters[cluster_id], cb)
-
-        # reconcile clusters
-        comm.Barrier()
+        # incremental passes only move the tracks that changed cluster, every
+        # REFRESH_PASSES passes the totals are rebuilt to shed rounding error
+        delta = (incremental and have_totals
+                 and npass % REFRESH_PASSES != 0)
+        with timings.phase("recompute"):
+            if delta:
+                # this rank's changes, scattered into a cleared buffer
+                reduction.fill(0)
+                add_moved_sums(reduction[:, :-1], reduction[:, -1], track_cache,
+                               old_labels, labels)
+            else:
+                sums, counts = cluster_sums(track_cache, labels, num_means)
+                reduction[:, :-1] = sums
+                reduction[:, -1] = counts
+
+        # reconcile clusters: sum the per-rank weighted sums and counts
+        # everywhere at once, the means are then exact on every rank
         update_text("Reconcile centroids...")
-        centroid_groups = [[] for x in xrange(0,num_means)]
-        if myrank == 0:
-            for i, cd in enumerate(centroids):
-                centroid_groups[i].append(cd)
-            update_progress(1,size)
-            for r in xrange(1,size):
-                in_centroids = comm.recv(source=MPI.ANY_SOURCE, tag=68)
-                in_cluster_counts = comm.recv(source=MPI.ANY_SOURCE, tag=69)
-                for i in xrange(num_means):
-                    centroid_groups[i].append(in_centroids[i])
-                    cluster_counts[i] += in_cluster_counts[i]
-                update_progress(r+1,size)
-            for cluster_id in xrange(num_means):
-                centroids[cluster_id] = vector_mean(centroid_groups[cluster_id])
+        timings.wait(comm)
+        with timings.phase("reconcile", reduction.nbytes + pass_stats.nbytes):
+            comm.Allreduce(MPI.IN_PLACE, reduction, op=MPI.SUM)
+            comm.Allreduce(MPI.IN_PLACE, pass_stats, op=MPI.SUM)
+        if delta:
+            totals += reduction
         else:
-            progressmgr.client_send()
-            comm.send(centroids, dest=0, tag=68)
-            update_text("Sending cluster_counts to root")
-            comm.send(cluster_counts, dest=0, tag=69)
-            update_text("[BLOCKED] Waiting for centroids and counts...")
-        centroids = comm.bcast(centroids, root=0)
-        cluster_counts = comm.bcast(cluster_counts, root=0)
-
-        if myrank == 0:
-            update_text("Accumulating clusters")
-            for r in xrange(1,size):
-                in_clusters = comm.recv(source=MPI.ANY_SOURCE, tag=70)
-                for i in xrange(num_means):
-                    for t_id in in_clusters[i]:
-                        clusters[i].append(t_id)
-                update_progress(r+1,size)
-        else:
-            update_text("Transferring clusters to root")
-            comm.send(clusters, dest=0, tag=70)
-        if myrank == 0:
-            update_text("Writing current state to file")
-            dump_clusters(clusters, cluster_counts, cluster_file, npass)
-            dump_centroids(cluster_counts, centroid_file, npass)
+            totals[...] = reduction
+            have_totals = True
+        old_centroids = centroids
+        centroids = cluster_means(totals[:, :-1], totals[:, -1], centroids, precision)
+        cluster_counts = np.rint(totals[:, -1]).astype(int).tolist()
+        done = convergence.update(pass_stats[0], total_docs, pass_stats[1],
+                                  centroid_shift(old_centroids, centroids))
+        update_text(convergence.status())
+        update_progress(1,1)
+
+        # every rank decides the same, done is computed from reduced values
+        if writing and (done or (npass + 1) % output_every == 0):
+            with timings.phase("gather", labels.nbytes):
+                all_labels = gather_labels(labels, rank_counts)
+            if summary_file is not None:
+                # the sums are already reduced, only the word usage is not
+                usage = word_counts(track_cache, labels, num_means)
+                with timings.phase("gather", usage.nbytes):
+                    comm.Reduce(MPI.IN_PLACE if myrank == 0 else usage, usage,
+                                op=MPI.SUM, root=0)
+            if myrank == 0:
+                update_text("Handing current state to the writer")
+                # blocks only while the writer is still busy with the last output
+                with timings.phase("output"):
+                    checkpoint = None
+                    if checkpoint_file is not None:
+                        checkpoint = Checkpoint(centroids, all_track_ids, all_labels,
+                                convergence.npass, convergence.objective,
+                                rng.get_state(), params, vocabulary)
+                    abort_on_error(writer.submit, write_output, all_track_ids, all_labels,
+                            centroids, cluster_counts, npass, centroid_file, cluster_file)
+                    if summary_file is not None:
+                        summary = ClusterSummary(totals[:, :-1].copy(), totals[:, -1].copy(), usage)
+                        abort_on_error(writer.submit, write_summary, summary, summary_file,
+                                       summary_words, npass)
+                    if checkpoint is not None:
+                        abort_on_error(writer.submit, save_checkpoint, checkpoint_file, checkpoint)
+        timings.end_pass()
         npass += 1
-        comm.Barrier()
-
-    update_text("DONE with {} passes".format(npass))
-    if myrank > 0: progressmgr.client_send()
-    comm.Barrier()
-    progressmgr.running = False
-
-    return clusters, cluster_counts
+        if done:
+            break
+
+    if writer is not None:
+        update_text("Waiting for output files")
+        with timings.phase("output"):
+            abort_on_error(writer.close)
+    update_text("DONE with {} passes: {}".format(npass, convergence.reason))
+    if postings:
+        # the last labels came from the centroids before the final update
+        with timings.phase("drift"):
+            ndiffer, lost, max_lost = drift(track_cache, old_centroids, labels, row_norms)
+            drift_stats = np.array([ndiffer, lost])
+            max_lost = np.array([max_lost])
+            comm.Allreduce(MPI.IN_PLACE, drift_stats, op=MPI.SUM)
+            comm.Allreduce(MPI.IN_PLACE, max_lost, op=MPI.MAX)
+        update_text("Postings drift: {:.0f} of {} tracks ({:.2%}) off their exact cluster, "
+                    "similarity lost mean {:.5f} max {:.5f}".format(drift_stats[0], total_docs,
+                    drift_stats[0] / max(total_docs, 1), drift_stats[1] / max(total_docs, 1),
+                    max_lost[0]))
+    progressmgr.flush()
+
+    return labels, cluster_counts
+
+def sweep(ks, restarts, out_prefix, method="kmeans||", convergence_args=None,
+          prune=False, incremental=False, summary_words=None, postings=None):
+    """ Run restarts seedings of k-means for every K in ks on the corpus
+        that is already loaded.  The best restart of every K, the one with
+        the highest exact objective (see final_objective()), gets one more
+        pass that writes its output to <out_prefix>_k<K>_*.  Returns a list
+        with one dict per run, the best run of every K marked with
+        "best": True. """
+    global centroids, num_means
+    results = []
+    for k in ks:
+        num_means = k
+        best = None
+        for restart in xrange(restarts):
+            update_text("K={} restart {}/{}".format(k, restart + 1, restarts))
+            pick_centroids(method)
+            convergence = Convergence.from_args(convergence_args)
+            labels, cluster_counts = main(None, None, convergence, prune, incremental,
+                                          output_every=None, postings=postings)
+            # the pass objective is not exact under --postings
+            objective = final_objective(labels)
+            results.append({ "k": k, "restart": restart, "best": False,
+                             "objective": objective,
+                             "passes": convergence.npass, "reason": convergence.reason })
+            if best is None or objective > best[0]:
+                best = (objective, centroids, len(results) - 1)
+        results[best[2]]["best"] = True
+        # one more pass from the best centroids, only to write its output
+        centroids = best[1]
+        prefix = "{}_k{}".format(out_prefix, k)
+        summary_file = prefix + "_summary" if summary_words else None
+        main(prefix + "_centroids", prefix + "_clusters", Convergence(max_passes=1),
+             summary_file=summary_file, summary_words=summary_words)
+    return results
+
+def final_objective(labels):
+    """ Sum over all ranks of the exact cosine similarity of every track to
+        the current centroid of its cluster in labels, this rank's labels.
+        One gather per nonzero, whatever assignment produced the labels. """
+    unit = normalize_centroids(centroids)
+    local = np.sum(assigned_similarities(track_cache, unit, labels, track_norms))
+    return comm.allreduce(float(local), op=MPI.SUM)
+
+def validate_precision(initial_centroids, labels, objective, npass, convergence_args,
+                       filename, prune=False, incremental=False, postings=None):
+    """ Run k-means again in float64 on the exact corpus from the centroids
+        the float32 run started from, and have rank 0 write a JSON report
+        comparing the labels, objective and memory of the two runs.  The
+        cluster ids of both runs line up because they start from the same
+        centroids. """
+    global track_cache, centroids, precision
+    compact = (track_cache, centroids, precision)
+    track_cache, centroids, precision = exact_cache, initial_centroids, np.float64
+    update_text("Validating: the same run in float64")
+    convergence = Convergence.from_args(convergence_args)
+    exact_labels, exact_counts = main(None, None, convergence, prune, incremental,
+                                      output_every=None, postings=postings)
+    exact_centroids = centroids
+    track_cache, centroids, precision = compact
+
+    # same labels, then the bytes of the corpus values in float32 and float64
+    stats = np.array([np.count_nonzero(labels == exact_labels),
+                      track_cache.values.nbytes, exact_cache.values.nbytes], dtype=np.float64)
+    comm.Allreduce(MPI.IN_PLACE, stats, op=MPI.SUM)
+    if myrank == 0:
+        name = np.dtype(precision).name
+        reduction_size = num_means * (len(words) + 1)
+        report = { "precision": name,
+                   "tracks": total_docs,
+                   "same_labels": int(stats[0]),
+                   "agreement": stats[0] / max(total_docs, 1),
+                   "objective": { name: objective, "float64": convergence.objective },
+                   "passes": { name: npass, "float64": convergence.npass },
+                   "centroid_max_difference": float(np.max(np.abs(
+                           centroids.astype(np.float64) - exact_centroids))),
+                   "corpus_value_bytes": { name: int(stats[1]), "float64": int(stats[2]) },
+                   "centroid_bytes": { name: centroids.nbytes,
+                                       "float64": exact_centroids.nbytes },
+                   "reduction_bytes": { name: reduction_size * np.dtype(precision).itemsize,
+                                        "float64": reduction_size * 8 } }
+        write_report(filename, report)
+        update_text("Validation: {:.2%} of the labels match float64".format(report["agreement"]))
+
+def relabel(corpus_path, labels):
+    """ Replace the projected corpus (see project_corpus.py) by the original
+        tfidf vectors at corpus_path, or of the tfidf database when it is
+        None, and set the centroids to the means of the clusters of labels,
+        this rank's labels of the projected run, in the original space.
+        Tracks are matched by id, the two corpora are split differently. """
+    global centroids
+    update_text("Relabeling in the original space")
+    with timings.phase("gather", track_cache.track_ids.nbytes + labels.nbytes):
+        all_track_ids, rank_counts = gather_track_ids()
+        all_labels = gather_labels(labels, rank_counts)
+        projected = Checkpoint(None, comm.bcast(all_track_ids, root=0),
+                               comm.bcast(all_labels, root=0), 0)
+    init(corpus_path)
+    labels = projected.labels_for(track_cache.track_ids)
+    # every rank has to fail together, or the others hang in the Allreduce
+    missing = comm.allreduce(int(np.count_nonzero(labels < 0)), op=MPI.SUM)
+    if missing:
+        raise ValueError("{} tracks of {} are not in the projected corpus".format(
+                         missing, corpus_path or MXM_TFIDF))
+    with timings.phase("recompute"):
+        sums, counts = cluster_sums(track_cache, labels, num_means)
+    reduction = np.empty((num_means, len(words) + 1))
+    reduction[:, :-1] = sums
+    reduction[:, -1] = counts
+    with timings.phase("reconcile", reduction.nbytes):
+        comm.Allreduce(MPI.IN_PLACE, reduction, op=MPI.SUM)
+    centroids = cluster_means(reduction[:, :-1], reduction[:, -1],
+                              np.zeros((num_means, len(words))), precision)
+
+def write_sweep(results, filename):
+    with open(filename, 'w') as f:
+        json.dump({ "runs": results,
+                    "best": [run for run in results if run["best"]] }, f, indent=2)
+        f.write("\n")
 
-def init_mpi():
+def init_mpi(progress_sink=None):
+    """ progress_sink is a progress.make_sink() spec, used on rank 0 """
     global myrank, size, comm, progressmgr
 
     comm = MPI.COMM_WORLD
     size = comm.Get_size()
     myrank = comm.Get_rank()
 
-    progressmgr = ProgressManager(comm, myrank, size)
-    progressmgr.start_handling()
-
-    comm.Barrier()
+    sink = None
+    if myrank == 0:
+        sink = make_sink(progress_sink)
+    progressmgr = ProgressChannel(comm, sink)
 
     update_text("{} checking in!".format(str(myrank)))
     update_progress(0,1)
 
-def dump_centroids(cluster_counts, filename, npass=0):
+def dump_centroids(centroids, cluster_counts, filename, npass=0):
     with open(filename, 'w') as f:
         f.write("Writing output at pass {}\n\n".format(npass))
         for i, centroid in enumerate(centroids):
             f.write("Cluster {} ({})\n{}\n".format(i, cluster_counts[i], "="*31))
-            words = centroid.items()
-            words.sort(key=lambda x: x[1], reverse=True)
-            for word, tfidf in words[:50]:
-                f.write("{:20} {:10f}\n".format(word.encode('utf-8'), tfidf))
+            for word_id in np.argsort(centroid)[::-1][:50]:
+                f.write("{:20} {:10f}\n".format(words[word_id].encode('utf-8'), centroid[word_id]))
             f.write("\n")
 
 def dump_clusters(clusters, cluster_counts, filename, npass=0):
@@ -291,22 +510,168 @@ def dump_clusters(clusters, cluster_counts, filename, npass=0):
             f.write("\n")
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        try:
-            num_means = int(sys.argv[1])
-        except ValueError:
-            dbg("Error, argument 1 must be an integer")
-    if len(sys.argv) > 2:
-        out_prefix = sys.argv[2]
-    else:
-        out_prefix = "{}means_output".format(num_means)
+    parser = argparse.ArgumentParser(description="k-means over the tfidf database with MPI")
+    parser.add_argument("k", type=int, nargs="?", default=num_means,
+                        help="number of clusters (default {})".format(num_means))
+    parser.add_argument("out_prefix", nargs="?",
+                        help="prefix of the output files (default <k>means_output)")
+    parser.add_argument("--corpus",
+                        help="binary corpus written by export_corpus.py, "
+                             "read instead of {}".format(MXM_TFIDF))
+    parser.add_argument("--init", choices=["random", "kmeans||"], default="kmeans||",
+                        help="how to pick the initial centroids (default kmeans||)")
+    parser.add_argument("--seed", type=int,
+                        help="random seed, makes runs with the same number of ranks repeatable")
+    parser.add_argument("--prune", action="store_true",
+                        help="skip centroids that cannot win using distance bounds "
+                             "(rarely pays off on sparse tfidf, see assign.PrunedAssigner)")
+    parser.add_argument("--postings", type=int, metavar="WORDS",
+                        help="approximate assignment over centroids truncated to their "
+                             "top WORDS words, kept as an inverted index; the drift from "
+                             "exact assignment is reported at the end")
+    parser.add_argument("--incremental", action="store_true",
+                        help="update centroid sums with only the tracks that changed cluster")
+    parser.add_argument("--precision", choices=["float64", "float32"], default="float64",
+                        help="dtype of the corpus, centroids and reduction buffer; sums "
+                             "over passes stay float64 (default float64)")
+    parser.add_argument("--validate", metavar="FILE",
+                        help="with --precision float32, run again in float64 from the same "
+                             "initial centroids and write a JSON report comparing the "
+                             "labels to FILE (keeps both corpora in memory)")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="rank 0 writes a checkpoint to FILE after every pass")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the --checkpoint FILE of an earlier run, "
+                             "with any number of ranks")
+    parser.add_argument("--output-every", type=int, default=1, metavar="N",
+                        help="write the output files (and checkpoint) every N "
+                             "passes and after the last one (default 1)")
+    parser.add_argument("--summary", type=int, metavar="N",
+                        help="also write the top N and the N most distinctive words "
+                             "of every cluster to <out_prefix>_summary")
+    parser.add_argument("--progress", metavar="SINK",
+                        help="where rank 0 reports progress: {}, optionally followed "
+                             "by :FILE (default terminal on a tty, log otherwise)".format(
+                             ", ".join(SINKS)))
+    parser.add_argument("--timing", metavar="FILE",
+                        help="write per-phase time, bytes sent and load imbalance "
+                             "over the ranks to FILE as JSON")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a cProfile dump of every rank to DIR/rank<N>.prof")
+    parser.add_argument("--sweep", type=int, nargs="+", metavar="K",
+                        help="cluster the corpus, loaded once, for every one of these K "
+                             "instead of k")
+    parser.add_argument("--restarts", type=int, default=1,
+                        help="seedings per K, only the best one is written (default 1)")
+    parser.add_argument("--model", metavar="FILE",
+                        help="save the centroids, vocabulary and idf weights to FILE "
+                             "for classifying new tracks (see track_lookup.py)")
+    parser.add_argument("--relabel", metavar="CORPUS", nargs="?", const="",
+                        help="with a --corpus written by project_corpus.py: afterwards "
+                             "load the original tfidf vectors of the binary CORPUS (of "
+                             "{} when not given) and run --relabel-passes passes there "
+                             "from the projected clusters; the output files are written "
+                             "in the original space".format(MXM_TFIDF))
+    parser.add_argument("--relabel-passes", type=int, default=1, metavar="N",
+                        help="passes in the original space with --relabel (default 1)")
+    Convergence.add_arguments(parser)
+    args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume needs --checkpoint FILE")
+    projected = (args.corpus is not None and
+                 os.path.exists(os.path.join(args.corpus, PROJECTION_FILE)))
+    relabeling = args.relabel is not None
+    if relabeling and not projected:
+        parser.error("--relabel needs a --corpus written by project_corpus.py")
+    if projected and args.model and not relabeling:
+        parser.error("a model of a projected corpus needs --relabel")
+    if args.postings is not None and args.prune:
+        parser.error("--postings is not combined with --prune")
+    if args.output_every < 1:
+        parser.error("--output-every must be at least 1")
+    if args.restarts < 1:
+        parser.error("--restarts must be at least 1")
+    if args.sweep is not None and min(args.sweep) < 1:
+        parser.error("every --sweep K must be at least 1")
+    sweeping = args.sweep is not None or args.restarts > 1
+    if args.validate and (args.precision == "float64" or sweeping or args.resume
+                          or relabeling):
+        parser.error("--validate needs --precision float32, and no --sweep, --restarts, "
+                     "--resume or --relabel")
+    if relabeling and (sweeping or args.checkpoint is not None):
+        parser.error("--relabel is not combined with --sweep, --restarts or --checkpoint")
+    if sweeping and (args.checkpoint is not None or args.model is not None):
+        parser.error("--sweep and --restarts do not write checkpoints or models")
+    num_means = args.k
+    out_prefix = args.out_prefix
+    if out_prefix is None:
+        out_prefix = "sweep_output" if sweeping else "{}means_output".format(num_means)
     cluster_file = out_prefix + "_clusters"
     centroid_file = out_prefix + "_centroids"
-
-    init_mpi()
-    init()
-    main(centroid_file,cluster_file)
-#    if myrank == 0:
-#        print("Process complete, cluster counts={}".format(cluster_counts))
-#        dump_centroids(cluster_counts, centroid_file)
-#        dump_clusters(clusters, cluster_counts, cluster_file)
+    summary_file = None
+    if args.summary:
+        summary_file = out_prefix + "_summary"
+
+    init_mpi(args.progress)
+    # with a report, time the waits for slower ranks separately
+    timings = Timings(wait_barrier=args.timing is not None)
+    profile = None
+    if args.profile:
+        profile = start_profile()
+    # every rank draws its own samples, so seed each one differently
+    rng = np.random.RandomState(None if args.seed is None else [args.seed, myrank])
+    precision = np.dtype(args.precision).type
+    init(args.corpus, keep_exact=args.validate is not None)
+    resume_from = None
+    if sweeping:
+        results = sweep(args.sweep or [args.k], args.restarts, out_prefix, args.init,
+                        args, args.prune, args.incremental, args.summary, args.postings)
+        if myrank == 0:
+            write_sweep(results, out_prefix + "_sweep.json")
+    elif args.resume:
+        # every rank reads the checkpoint itself
+        resume_from = load_checkpoint(args.checkpoint)
+        try:
+            resume_from.check_vocabulary(words)
+        except ValueError as e:
+            # every rank reads the same checkpoint and vocabulary, so all stop
+            parser.error("cannot resume from {}: {}".format(args.checkpoint, e))
+        centroids = resume_from.centroids.astype(precision)
+        num_means = len(centroids)
+        if myrank == 0 and resume_from.rng_state is not None:
+            rng.set_state(resume_from.rng_state)
+        update_text("Resuming after pass {} with K={}".format(resume_from.npass, num_means))
+        comm.Barrier()
+    else:
+        pick_centroids(args.init)
+    if not sweeping:
+        initial_centroids = centroids
+        convergence = Convergence.from_args(args)
+        if relabeling:
+            # only the passes in the original space write output
+            labels, cluster_counts = main(None, None, convergence, args.prune,
+                 args.incremental, output_every=None, postings=args.postings)
+            original = args.relabel or None
+            relabel(original, labels)
+            labels, cluster_counts = main(centroid_file, cluster_file,
+                 Convergence(max_passes=args.relabel_passes), params=vars(args),
+                 summary_file=summary_file, summary_words=args.summary)
+        else:
+            original = args.corpus
+            labels, cluster_counts = main(centroid_file, cluster_file, convergence, args.prune,
+                 args.incremental, args.checkpoint, vars(args), resume_from,
+                 args.output_every, summary_file, args.summary, args.postings)
+        if args.model and myrank == 0:
+            Model(centroids, words, load_idf(original, MXM_TFIDF), vars(args)).save(args.model)
+    if profile is not None:
+        stop_profile(profile, args.profile, myrank)
+    if args.timing:
+        report = timings.report(comm)
+        if myrank == 0:
+            write_report(args.timing, report)
+    if args.validate:
+        # after the timing report, which covers only the run itself
+        validate_precision(initial_centroids, labels, convergence.objective,
+                           convergence.npass, args, args.validate, args.prune,
+                           args.incremental, args.postings)
+    progressmgr.close()
@@ -0,0 +1,40 @@
+# minibatch.py
+# mini-batch k-means (Sculley 2010, "Web-scale k-means clustering")
+#
+# Instead of assigning every track on every pass, each iteration assigns a
+# small random batch and moves its centroids toward the batch members with a
+# per-cluster learning rate of 1 / (tracks seen so far by that cluster).
+# Memory use is bounded by the batch size, not the corpus size.
+
+import numpy as np
+from assign import assign, cluster_sums
+from seeding import kmeans_plusplus
+
+def minibatch_kmeans(draw_batch, k, rng, batch_size=1000, iterations=100,
+                     centroids=None, callback=None):
+    """ Return (centroids, counts) after the given number of iterations.
+
+        draw_batch(n) must return a Corpus of n random tracks, or of every
+        track when there are fewer than n.  Unless
+        centroids are given, they are seeded with k-means++ on a first batch
+        of 3k tracks.  counts is the number of sampled tracks each cluster
+        absorbed.  callback, if given, is called after every iteration with
+        the iteration number and the mean similarity of the batch.
+    """
+    if centroids is None:
+        centroids = kmeans_plusplus(draw_batch(max(batch_size, 3 * k)), k, rng)
+    centroids = np.array(centroids, dtype=np.float64)
+    counts = np.zeros(k)
+    for i in xrange(iterations):
+        batch = draw_batch(batch_size)
+        labels, similarities = assign(batch, centroids)
+        sums, batch_counts = cluster_sums(batch, labels, k)
+        counts += batch_counts
+        # c += (sum(x) - n c) / v is the per-track update c += (x - c) / v
+        # summed over the batch members of the cluster
+        hit = batch_counts > 0
+        centroids[hit] += ((sums[hit] - batch_counts[hit, np.newaxis] * centroids[hit])
+                           / counts[hit, np.newaxis])
+        if callback is not None:
+            callback(i + 1, np.mean(similarities))
+    return centroids, counts
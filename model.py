@@ -0,0 +1,109 @@
+# model.py
+# a finished clustering saved to a file, to place tracks that were not part
+# of the run without clustering again
+#
+# A model holds the normalized centroids, the vocabulary and the idf weight
+# of every word.  That is enough to turn the raw bag-of-words counts of a new
+# track into the tfidf vector get_tfidf.py would have computed and to score
+# it against every cluster.
+
+import json
+import numpy as np
+from corpus import Corpus
+from read_tfidf import TFIDFDb
+from assign import normalize_centroids, row_blocks, block_similarities
+from summary import top_columns
+
+class Model(object):
+    """ Nearest-centroid classifier over the clusters of a k-means run.
+
+        centroids -- (K, nwords) centroids, normalized here
+        words     -- vocabulary, words[word_id] is the word string
+        idf       -- idf weight of every word_id
+        params    -- dictionary describing the run, stored as JSON
+    """
+
+    def __init__(self, centroids, words, idf, params=None):
+        self.centroids = normalize_centroids(centroids)
+        self.words = list(words)
+        self.idf = np.asarray(idf, dtype=np.float64)
+        self.params = params or {}
+        self.centroids_t = np.ascontiguousarray(self.centroids.T)
+        self._word_index = None
+
+    def __len__(self):
+        return len(self.centroids)
+
+    def word_index(self):
+        if self._word_index is None:
+            self._word_index = dict((word, i) for i, word in enumerate(self.words))
+        return self._word_index
+
+    def corpus(self, track_ids, bags):
+        """ Return a Corpus of tfidf vectors for bags, one iterable of
+            (word, count) pairs per track id.  tf is the count over the
+            total count of the track, as in get_tfidf.py; words outside the
+            vocabulary are ignored. """
+        word_index = self.word_index()
+        indptr = [0]
+        word_ids = []
+        counts = []
+        for bag in bags:
+            for word, count in bag:
+                word_id = word_index.get(word)
+                if word_id is not None:
+                    word_ids.append(word_id)
+                    counts.append(count)
+            indptr.append(len(word_ids))
+        indptr = np.array(indptr, dtype=np.int64)
+        word_ids = np.array(word_ids, dtype=np.int32)
+        counts = np.array(counts, dtype=np.float64)
+        lengths = np.diff(indptr)
+        totals = np.ones(len(lengths))
+        nonempty = lengths > 0
+        if nonempty.any():
+            totals[nonempty] = np.add.reduceat(counts, indptr[:-1][nonempty])
+        values = counts / np.repeat(totals, lengths) * self.idf[word_ids]
+        return Corpus(indptr, word_ids, values, track_ids, self.words)
+
+    def classify(self, corpus, top=1):
+        """ Return (labels, scores), (len(corpus), top) arrays of the top
+            nearest clusters of every track, best first, and their cosine
+            similarities.  Tracks without words score 0 everywhere. """
+        k = len(self)
+        top = min(top, k)
+        row_norms = corpus.row_norms()
+        labels = np.empty((len(corpus), top), dtype=np.int32)
+        scores = np.empty((len(corpus), top))
+        for start, end in row_blocks(corpus, k):
+            sims = block_similarities(corpus, start, end, self.centroids_t, row_norms)
+            if top == 1:
+                best = np.argmax(sims, axis=1)[:, np.newaxis]
+            else:
+                best = top_columns(sims, top)
+            labels[start:end] = best
+            scores[start:end] = sims[np.arange(end - start)[:, np.newaxis], best]
+        return labels, scores
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, idf=self.idf,
+                     words=np.array([word.encode('utf-8') for word in self.words]),
+                     params=np.array(json.dumps(self.params)))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["centroids"], [word.decode('utf-8') for word in data["words"]],
+                       data["idf"], json.loads(str(data["params"])))
+
+def load_idf(corpus_path=None, tfidf_db=None):
+    """ idf weights of the binary corpus at corpus_path (see export_corpus.py),
+        or else of the tfidf database """
+    if corpus_path is not None:
+        idf = Corpus.load_idf(corpus_path)
+        if idf is None:
+            raise IOError("{} has no idf weights, export it again with "
+                          "export_corpus.py".format(corpus_path))
+        return idf
+    return TFIDFDb(tfidf_db).idf()
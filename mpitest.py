@@ -2,7 +2,7 @@ from mpi4py import MPI
 from time import sleep
 from threading import Timer
 import sys
-from progress import ProgressManager
+from progress import ProgressChannel
 from random import random, randint
 
 comm = MPI.COMM_WORLD
@@ -52,9 +52,8 @@ def testMsgReceiver():
             sleep(random())
 
 
-def testProgressManager():
-    p = ProgressManager(comm, rank, size)
-    p.start_handling()
+def testProgressChannel():
+    p = ProgressChannel(comm)
 
     if rank == 0:
         p.update_text("I'm root bitch!")
@@ -69,11 +68,10 @@ def testProgressManager():
             p.update_progress(i,prog-1)
             sleep(random())
         p.update_text("Done")
-        p.client_send()
 
-    p.running = False
+    p.close()
 if __name__ == '__main__':
-    testProgressManager()
+    testProgressChannel()
 
 #
 #
@@ -0,0 +1,118 @@
+# parallel.py
+# multi-core k-means passes on one machine, without MPI
+#
+# The corpus is copied once into shared memory before the worker processes
+# are forked.  Every pass the parent writes the centroids into shared memory,
+# each worker assigns its own nonzero-balanced range of tracks and writes its
+# labels and per-cluster partial sums back into shared memory, and the parent
+# adds up the partial sums.  Nothing but chunk numbers is ever pickled.
+
+import ctypes
+from multiprocessing import Pool, cpu_count
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from corpus import Corpus, balanced_splits
+from assign import assign, cluster_sums
+
+# set in every worker by _init_worker()
+_worker = None
+
+def shared_array(shape, dtype):
+    """ Return (raw, array): a shared memory block and a numpy view of it.
+        Pass raw to child processes and rebuild the view with as_array(). """
+    dtype = np.dtype(dtype)
+    raw = RawArray(ctypes.c_char, max(1, int(np.prod(shape)) * dtype.itemsize))
+    return raw, as_array(raw, shape, dtype)
+
+def as_array(raw, shape, dtype):
+    return np.frombuffer(raw, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+class _Worker(object):
+    """ Worker side views of the shared buffers """
+
+    def __init__(self, buffers, splits, k, words):
+        arrays = dict((name, as_array(*spec)) for name, spec in buffers.iteritems())
+        self.corpus = Corpus(arrays["indptr"], arrays.get("word_ids"), arrays["values"],
+                             np.arange(len(arrays["row_norms"])), words)
+        self.arrays = arrays
+        self.splits = splits
+        self.k = k
+
+    def run(self, chunk):
+        start, end = self.splits[chunk], self.splits[chunk+1]
+        a = self.arrays
+        sub = self.corpus.slice_rows(start, end)
+        labels, similarities = assign(sub, a["centroids"], a["row_norms"][start:end])
+        a["labels"][start:end] = labels
+        a["similarities"][start:end] = similarities
+        a["sums"][chunk], a["counts"][chunk] = cluster_sums(sub, labels, self.k)
+        return chunk
+
+def _init_worker(buffers, splits, k, words):
+    global _worker
+    _worker = _Worker(buffers, splits, k, words)
+
+def _run_chunk(chunk):
+    return _worker.run(chunk)
+
+class PoolEngine(object):
+    """ Runs the assignment and centroid-sum steps of every pass on a pool
+        of worker processes that share one copy of the corpus.
+
+        Memory: besides the shared corpus there is one shared (K, nwords)
+        partial sum slot per worker, K * nwords * 8 bytes per process.
+        corpus is a Corpus over the shared copy, the caller should drop
+        its own to keep a single copy in the parent.
+    """
+
+    def __init__(self, corpus, k, processes=None, row_norms=None):
+        if processes is None:
+            processes = cpu_count()
+        if row_norms is None:
+            row_norms = corpus.row_norms()
+        self.k = k
+        self.splits = balanced_splits(corpus.indptr, processes)
+        nchunks = len(self.splits) - 1
+        specs = { "indptr": (corpus.indptr, np.int64),
+                  "values": (corpus.values, np.float64),
+                  "row_norms": (row_norms, np.float64) }
+        if not corpus.dense:
+            specs["word_ids"] = (corpus.word_ids, np.int32)
+        buffers = {}
+        self.arrays = {}
+        for name, (source, dtype) in specs.iteritems():
+            raw, array = shared_array(source.shape, dtype)
+            array[...] = source
+            buffers[name] = (raw, source.shape, dtype)
+            self.arrays[name] = array
+        self.corpus = Corpus(self.arrays["indptr"], self.arrays.get("word_ids"),
+                             self.arrays["values"], corpus.track_ids, corpus.words)
+        outputs = { "centroids": ((k, corpus.nwords), np.float64),
+                    "labels": ((len(corpus),), np.int32),
+                    "similarities": ((len(corpus),), np.float64),
+                    "sums": ((nchunks, k, corpus.nwords), np.float64),
+                    "counts": ((nchunks, k), np.int64) }
+        for name, (shape, dtype) in outputs.iteritems():
+            raw, self.arrays[name] = shared_array(shape, dtype)
+            buffers[name] = (raw, shape, dtype)
+        self.pool = Pool(processes, initializer=_init_worker,
+                         initargs=(buffers, self.splits, k, corpus.words))
+
+    def run_pass(self, centroids, callback=None):
+        """ Assign every track to the nearest of centroids.  Returns
+            (labels, similarities, sums, counts) like assign() followed by
+            cluster_sums() on the whole corpus.  callback, if given, is
+            called with the number of tracks done as chunks finish. """
+        a = self.arrays
+        a["centroids"][...] = centroids
+        done = 0
+        for chunk in self.pool.imap_unordered(_run_chunk, xrange(len(self.splits) - 1)):
+            done += self.splits[chunk+1] - self.splits[chunk]
+            if callback is not None:
+                callback(done)
+        return (a["labels"].copy(), a["similarities"].copy(),
+                a["sums"].sum(axis=0), a["counts"].sum(axis=0))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,161 @@
+# postings.py
+# approximate assignment step over centroids truncated to their heaviest words
+#
+# Every centroid keeps only its `truncate` largest weights, renormalized to
+# unit length, and the kept weights are stored as an inverted index: for
+# every word the (cluster, weight) postings of the centroids that kept it.
+# A track is then scored by walking the postings of its own ~50 words,
+# instead of multiplying its words with all K dense centroids; only the
+# most common words, which nearly every centroid keeps, stay dense.
+# Tracks are only compared on the words the centroids kept, so the labels
+# can differ from the exact ones; drift() measures by how much.
+
+import numpy as np
+from assign import assign, normalize_centroids, row_blocks, assigned_similarities
+from summary import top_columns
+
+# default number of words every centroid keeps
+TRUNCATE = 300
+# words kept by at least 1 / DENSE_RATIO of the centroids are scored densely
+DENSE_RATIO = 8
+
+# centroids truncated at once, bounds the temporaries of top_columns()
+TRUNCATE_ROWS = 64
+
+def truncate_centroids(centroids, truncate):
+    """ Return (word_ids, weights), (K, truncate) arrays of the heaviest
+        words of every centroid and their weights, rows of unit length.
+        Centroids are done TRUNCATE_ROWS at a time, so there is no full
+        normalized copy of them. """
+    k = len(centroids)
+    word_ids = np.empty((k, truncate), dtype=np.int64)
+    weights = np.empty((k, truncate))
+    for start in xrange(0, k, TRUNCATE_ROWS):
+        block = np.asarray(centroids[start:start+TRUNCATE_ROWS], dtype=np.float64)
+        # scaling a row does not change its heaviest words
+        word_ids[start:start+len(block)] = top_columns(block, truncate)
+        weights[start:start+len(block)] = block[np.arange(len(block))[:, np.newaxis],
+                                                word_ids[start:start+len(block)]]
+    norms = np.sqrt(np.sum(np.square(weights), axis=1))
+    norms[norms == 0] = 1
+    return word_ids, weights / norms[:, np.newaxis]
+
+class PostingsAssigner(object):
+    """ Same contract as assign.PrunedAssigner: assign(centroids) returns
+        (labels, similarities), here against the truncated centroids.
+
+        Walking a posting costs numpy several gathers and a scatter, about
+        DENSE_RATIO times a dense product, and by Zipf's law the common
+        words are kept by nearly every centroid.  Words kept by at least
+        1 / DENSE_RATIO of the centroids therefore stay a small dense
+        (nhead, K) block scored like assign() does, only the rest go
+        through the postings.  Both hold the same truncated weights, so
+        the split changes the speed but not the labels.
+
+        This is not a memory saving: the caller keeps its dense centroids,
+        the index only stands in for the transposed copy assign() makes.
+
+        computed / possible is the number of dense products plus postings
+        walked over the nonzero times centroid products of assign().
+    """
+
+    def __init__(self, corpus, row_norms=None, truncate=TRUNCATE):
+        if row_norms is None:
+            row_norms = corpus.row_norms()
+        self.corpus = corpus
+        self.row_norms = row_norms
+        self.truncate = truncate
+        self.computed = 0
+        self.possible = 0
+
+    def index(self, centroids):
+        """ Split the truncated centroids into the dense head block and the
+            inverted index of the other words """
+        k = len(centroids)
+        nwords = self.corpus.nwords
+        word_ids, weights = truncate_centroids(centroids, min(self.truncate, nwords))
+        clusters = np.repeat(np.arange(k, dtype=np.int32), weights.shape[1])
+        word_ids = word_ids.ravel()
+        weights = weights.ravel()
+        lengths = np.bincount(word_ids, minlength=nwords)
+        head = lengths * DENSE_RATIO >= k
+        # head_index[word_id] is the row of the word in head_t, -1 in the postings
+        self.head_index = np.empty(nwords, dtype=np.int64)
+        self.head_index.fill(-1)
+        self.head_index[head] = np.arange(np.count_nonzero(head))
+        self.head_t = np.zeros((np.count_nonzero(head), k))
+        dense = head[word_ids]
+        self.head_t[self.head_index[word_ids[dense]], clusters[dense]] = weights[dense]
+        tail = ~dense
+        order = np.argsort(word_ids[tail], kind="mergesort")
+        self.k = k
+        self.clusters = clusters[tail][order]
+        self.weights = weights[tail][order]
+        self.lengths = np.where(head, 0, lengths)
+        self.starts = np.append(0, np.cumsum(self.lengths))[:-1]
+
+    def block_similarities(self, start, end):
+        """ Cosine similarity of rows start:end to the truncated centroids """
+        corpus = self.corpus
+        k = self.k
+        nrows = end - start
+        lo, hi = corpus.indptr[start], corpus.indptr[end]
+        word_ids = corpus.word_ids[lo:hi]
+        values = corpus.values[lo:hi]
+        rows = np.repeat(np.arange(nrows), np.diff(corpus.indptr[start:end+1]))
+        heads = self.head_index[word_ids]
+        dense = heads >= 0
+        sims = np.zeros((nrows, k))
+
+        # head words: a dense product as in assign.block_similarities()
+        if dense.any():
+            products = self.head_t[heads[dense]]
+            products *= values[dense, np.newaxis]
+            counts = np.bincount(rows[dense], minlength=nrows)
+            nonempty = counts > 0
+            offsets = np.append(0, np.cumsum(counts))[:-1]
+            sims[nonempty] = np.add.reduceat(products, offsets[nonempty], axis=0)
+            self.computed += products.size
+
+        # the other words: walk their postings, positions found the way
+        # Corpus.take() finds rows
+        word_ids = word_ids[~dense]
+        hits = self.lengths[word_ids]
+        total = hits.sum()
+        if total:
+            offsets = np.append(0, np.cumsum(hits))[:-1]
+            positions = np.repeat(self.starts[word_ids] - offsets, hits) + np.arange(total)
+            keys = np.repeat(rows[~dense] * k, hits) + self.clusters[positions]
+            contributions = np.repeat(values[~dense], hits) * self.weights[positions]
+            sims += np.bincount(keys, contributions, minlength=nrows * k).reshape(nrows, k)
+            self.computed += total
+        sims /= self.row_norms[start:end, np.newaxis]
+        return sims
+
+    def assign(self, centroids, callback=None):
+        self.index(centroids)
+        corpus = self.corpus
+        labels = np.empty(len(corpus), dtype=np.int32)
+        similarities = np.empty(len(corpus))
+        self.computed = 0
+        self.possible = corpus.nnz * self.k
+        for start, end in row_blocks(corpus, self.k):
+            sims = self.block_similarities(start, end)
+            labels[start:end] = np.argmax(sims, axis=1)
+            similarities[start:end] = sims[np.arange(end - start), labels[start:end]]
+            if callback is not None:
+                callback(end)
+        return labels, similarities
+
+def drift(corpus, centroids, labels, row_norms=None):
+    """ Compare labels with the exact assignment to the full centroids.
+        Returns (ndiffer, lost, max_lost): the number of tracks labeled
+        differently, and the total and largest cosine similarity lost by
+        using labels instead of the exact nearest centroids. """
+    if row_norms is None:
+        row_norms = corpus.row_norms()
+    exact, best = assign(corpus, centroids, row_norms)
+    chosen = assigned_similarities(corpus, normalize_centroids(centroids), labels, row_norms)
+    lost = np.maximum(best - chosen, 0)
+    return (int(np.count_nonzero(exact != labels)), float(lost.sum()),
+            float(lost.max()) if len(lost) else 0.0)
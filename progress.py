@@ -1,181 +1,235 @@
-import os
-from time import sleep, time
-from threading import Timer, Lock
-from mpi4py import MPI
-from math import ceil
+# progress.py
+# progress reporting for mpi4py jobs
+#
+# Every rank keeps only its latest message and (done, total) pair.  At most
+# every UPDATE_TIMEOUT seconds a rank sends that state to rank 0 with a
+# non-blocking isend, skipped while the previous one is still in flight.
+# Rank 0 picks up whatever has arrived with iprobe at the same moments and
+# hands the ranks that changed to a sink: a terminal grid, a plain log or a
+# JSON-lines stream.  There are no timer threads and nothing ever waits on
+# the compute path; close() collects the final state of every rank.
+
 import sys
+import json
+from time import time
+from mpi4py import MPI
 
 BORDER_H = "-"
 BORDER_V = "|"
 BORDER_T = "+"
 ROWS = 5
 
-MESSAGE_TAG = 98
 PROGRESS_TAG = 99
 
-SEC_CHANCE = 0.05
 UPDATE_TIMEOUT = 2.0
 
-class ProgressManager(object):
-    """ 256 threads tryin to blast updates gets out of hand! """
-
-    def __init__(self, comm, myrank, size, maxwidth=50):
-        self.comm = comm
-        self.myrank = myrank
-        self.size = size
-        self.running = False
-        self.last_message = ''
-        self.last_send_message = 0
-        self.last_progress = (0,1)
-        self.last_send_progress = 0
-        self.request_m = None
-        self.request_p = None
-
-        # these are for node 0
+SINKS = [ "terminal", "log", "json" ]
+
+class RankState(object):
+    __slots__ = ("message", "done", "total")
+
+    def __init__(self, message="", done=0, total=1):
+        self.message = message
+        self.done = done
+        self.total = total
+
+    def values(self):
+        return (self.message, self.done, self.total)
+
+def progress_string(done, total, length):
+    perc_done = done / float(max(total, 1))
+    return "{:6.2f}%  [{:{length}}] {}/{}".format(perc_done * 100,
+                                                  "#" * int(perc_done * length),
+                                                  done, total, length=length)
+
+class TerminalSink(object):
+    """ Grid of one box per rank, redrawn in place with ANSI escapes """
+
+    def __init__(self, stream=sys.stderr, maxwidth=50):
+        self.stream = stream
         self.maxwidth = maxwidth
-        self.messages = ['' for x in xrange(size)]
-        self.progress = [[0,1] for x in xrange(size)]
-        self.dirtylock = Lock()
-        self.dirty = set()
-        if myrank == 0:
-            #self.rows, self.columns = os.popen('stty size', 'r').read().split()
-#            self.rows = 63
-#            self.columns = 105
-            self.rows = 71
-            self.columns = 211
-
-    def start_handling(self):
+        self.rows, self.columns = terminal_size(stream)
+        self.cleared = False
+
+    def write(self, states, changed):
+        if not self.cleared:
+            self.stream.write("\033[2J")     # clear the screen
+            self.cleared = True
+            changed = xrange(len(states))
+        pcols = max(1, self.columns / self.maxwidth)
+        for rank in changed:
+            self._blit(rank / pcols, rank % pcols, states[rank])
+        self.stream.write("\033[{};1H".format(self.rows))
+        self.stream.flush()
+
+    def _blit(self, i, j, state):
+        r = i * ROWS + 1
+        c = j * self.maxwidth + 1
+        if r + 4 > self.rows:
+            return       # out of screen
+        width = self.maxwidth - 1
+        lines = [ "{c}{h:-^{len}}{c}".format(c=BORDER_T, h=BORDER_H, len=width),
+                  "{v}{:{len}}".format("", v=BORDER_V, len=width),
+                  "{v}{message:^{len}.{len}}".format(message=state.message, v=BORDER_V, len=width),
+                  "{v}{progress:^{len}}".format(v=BORDER_V, len=width,
+                        progress=progress_string(state.done, state.total, self.maxwidth - 25)),
+                  "{v}{:{len}}".format("", v=BORDER_V, len=width) ]
+        for n, line in enumerate(lines):
+            self.stream.write("\033[{};{}H{}".format(r + n, c, line))
+
+    def close(self):
+        self.stream.write("\n")
+        close_stream(self.stream)
+
+class LogSink(object):
+    """ One plain text line per changed rank, for files and batch logs """
+
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.start = time()
+
+    def write(self, states, changed):
+        elapsed = time() - self.start
+        for rank in changed:
+            message, done, total = states[rank].values()
+            self.stream.write("{:9.1f}s  rank {:3}  {}/{}  {}\n".format(
+                    elapsed, rank, done, total, message))
+        self.stream.flush()
+
+    def close(self):
+        close_stream(self.stream)
+
+class JSONLinesSink(LogSink):
+    """ One JSON object per changed rank and line, for schedulers and scripts """
+
+    def write(self, states, changed):
+        now = time()
+        for rank in changed:
+            message, done, total = states[rank].values()
+            self.stream.write(json.dumps({ "time": now, "elapsed": now - self.start,
+                                           "rank": rank, "message": message,
+                                           "done": done, "total": total }) + "\n")
+        self.stream.flush()
+
+def close_stream(stream):
+    """ Flush stream, and close it if it is a file opened by make_sink() """
+    stream.flush()
+    if stream is not sys.stderr:
+        stream.close()
+
+def terminal_size(stream):
+    """ (rows, columns) of the terminal behind stream, 24x80 if unknown """
+    try:
+        import fcntl, termios, struct
+        rows, columns = struct.unpack("hh", fcntl.ioctl(stream.fileno(), termios.TIOCGWINSZ, "1234"))
+        if rows > 0 and columns > 0:
+            return rows, columns
+    except (ImportError, IOError, AttributeError, ValueError):
+        pass
+    return 24, 80
+
+def make_sink(spec=None):
+    """ Return a sink for spec, "terminal", "log" or "json", optionally
+        followed by ":FILE" to write there instead of stderr.  Without a
+        spec the terminal grid is used on a tty and the log otherwise. """
+    if spec is None:
+        spec = "terminal" if sys.stderr.isatty() else "log"
+    kind, _, filename = spec.partition(":")
+    if kind not in SINKS:
+        raise ValueError("unknown progress sink {!r}, use one of {}".format(kind, ", ".join(SINKS)))
+    stream = open(filename, "a", 1) if filename else sys.stderr
+    if kind == "terminal":
+        return TerminalSink(stream)
+    if kind == "json":
+        return JSONLinesSink(stream)
+    return LogSink(stream)
+
+class ProgressChannel(object):
+    """ Collects the progress of all ranks on rank 0 and writes it to sink.
+
+        Creating and closing the channel are collective, update_text() and
+        update_progress() are not and only cost a clock read unless an
+        update is due.  sink is only used on rank 0.
+    """
+
+    def __init__(self, comm, sink=None, interval=UPDATE_TIMEOUT):
+        # a private communicator, so progress never matches anyone else's recv
+        self.comm = comm.Dup()
+        self.myrank = self.comm.Get_rank()
+        self.size = self.comm.Get_size()
+        self.interval = interval
+        self.state = RankState()
+        self.last_flush = 0
+        self.dirty = True
+        # client side
+        self.request = None
+        self.sent = 0
+        # rank 0 side
+        self.sink = sink
         if self.myrank == 0:
-            self.start_handling_root()
-    def client_send_message(self):
-        if self.request_m is None and self.last_message is not None:
-            self.request_m = self.comm.isend(self.last_message, dest=0, tag=98)
-            self.last_message = None
-        if self.request_m is not None:
-            res = self.request_m.test()
-            if res[0]:
-                self.request_m = None
-        self.last_send_message = time()
-    def client_send_progress(self):
-        if self.request_p is None and self.last_progress is not None:
-            self.request_p = self.comm.isend(self.last_progress, dest=0, tag=99)
-            self.last_progress = None
-        if self.request_p is not None:
-            res = self.request_p.test()
-            if res[0]:
-                self.request_p = None
-        self.last_send_progress = time()
-    def client_send(self):
-        self.client_send_message()
-        self.client_send_progress()
-            
-    def start_handling_root(self):
-        self.running = True
-        self._redraw(clear=True)
-        def handler():
-            handle()
-        def handle():
-            attempt = 0
-            while attempt < 3:
-                # get a new request if we're not already waiting for one
-                if self.request_m is None:
-                    self.request_m = self.comm.irecv(dest=MPI.ANY_SOURCE, tag=98)
-                if self.request_p is None:
-                    self.request_p = self.comm.irecv(dest=MPI.ANY_SOURCE, tag=99)
-                # check the status
-                status = MPI.Status()
-                res = MPI.Request.testany((self.request_m, self.request_p), status=status)
-                if res[1]:
-                    if res[0] == 0:
-                        self.messages[status.Get_source()] = res[2]
-                        self.request_m = None
-                        with self.dirtylock:
-                            self.dirty.add(status.Get_source())
-                    elif res[0] == 1:
-                        self.progress[status.Get_source()] = res[2]
-                        self.request_p = None
-                        with self.dirtylock:
-                            self.dirty.add(status.Get_source())
-                else:
-                    sleep(SEC_CHANCE)
-                    attempt += 1
-            self._redraw()
-            if self.running:
-                Timer(UPDATE_TIMEOUT, handler).start()
-        handler()
-
-    def _redraw(self, clear=False):
-#        try:
-#            self.rows, self.columns = os.popen('stty size', 'r').read().split()
-#        except ValueError:
-#            pass
-
-        pcols = self.columns / self.maxwidth
-        prows = int(ceil(self.size / float(pcols)))
-
-        def _blit_status(i, j):
-            rank = i*pcols + j
-            r = i * ROWS + 1
-            c = j * self.maxwidth + 1
-            if r + 4 > self.rows:
-                return       # out of screen
-            sys.stderr.write("\033[{};{}H".format(r,c))
-            sys.stderr.write("{c}{h:-^{len}}{c}".format(c=BORDER_T,h=BORDER_H,len=self.maxwidth-1))
-            sys.stderr.write("\033[{};{}H".format(r+1,c))
-            sys.stderr.write("{v}{:{len}}".format("", v=BORDER_V, len=self.maxwidth-1))
-            sys.stderr.write("\033[{};{}H".format(r+2,c))
-            sys.stderr.write("{v}{message:^{len}}".format(message=self.messages[rank],v=BORDER_V,len=self.maxwidth-1))
-            sys.stderr.write("\033[{};{}H".format(r+3,c))
-            sys.stderr.write("{v}{progress:^{len}}".format(progress=self._get_progress_string(*self.progress[rank]),
-                                            len=self.maxwidth-1,
-                                            v=BORDER_V))
-            sys.stderr.write("\033[{};{}H".format(r+4,c))
-            sys.stderr.write("{v}{:{len}}".format("", v=BORDER_V, len=self.maxwidth-1))
-
-        if clear:
-            sys.stderr.write("\033[2J")     # clear the screen
-            for i in xrange(prows):
-                for j in xrange(pcols):
-                    rank = i*pcols + j
-                    if rank > self.size - 1:
-                        break
-                    _blit_status(i,j)
-        else:
-            dirty = self.dirty.copy()
-            with self.dirtylock:
-                self.dirty = set()
-            for rank in dirty:
-                i = rank / pcols
-                j = rank - i*pcols
-                _blit_status(i,j)
-
-    def _get_progress_string(self, comp, total):
-        length = self.maxwidth - 25
-        perc_done = comp / float(total)
-        progress = "#" * int((comp / float(total)) * length)
-        output = "{:6.2f}%  [{:{length}}] {}/{}".format(perc_done * 100, 
-                                                    progress, comp, total,
-                                                    length=length)
-        return output
+            if self.sink is None:
+                self.sink = make_sink()
+            self.states = [RankState() for x in xrange(self.size)]
+            self.states[0] = self.state
+            self.received = [0] * self.size
+            self.changed = set([0])
 
     def update_text(self, message):
-        """ format a message for printing and send it to the master node """
-        # move up two lines and spit out the pass number, and percentage done
-        if self.myrank > 0:
-            self.last_message = message
-            if time() - self.last_send_message > UPDATE_TIMEOUT:
-                self.client_send()
-        else:
-            self.messages[0] = message
-            with self.dirtylock:
-                self.dirty.add(0)
+        self.state.message = message
+        self._changed()
+
+    def update_progress(self, done, total):
+        self.state.done = done
+        self.state.total = total
+        self._changed()
+
+    def _changed(self):
+        self.dirty = True
+        if time() - self.last_flush >= self.interval:
+            self.flush()
 
-    def update_progress(self, comp, total):
+    def flush(self):
+        """ Send (client) or gather and write (rank 0) what is pending now """
+        self.last_flush = time()
         if self.myrank > 0:
-            self.last_progress = (comp,total)
-            if time() - self.last_send_progress > UPDATE_TIMEOUT:
-                self.client_send()
+            if self.request is not None and self.request.Test():
+                self.request = None
+            if self.request is None and self.dirty:
+                self.request = self.comm.isend(self.state.values(), dest=0, tag=PROGRESS_TAG)
+                self.sent += 1
+                self.dirty = False
         else:
-            self.progress[0] = (comp, total)
-            with self.dirtylock:
-                self.dirty.add(0)
+            status = MPI.Status()
+            while self.comm.iprobe(source=MPI.ANY_SOURCE, tag=PROGRESS_TAG, status=status):
+                self._receive(status.Get_source())
+            if self.dirty:
+                self.changed.add(0)
+                self.dirty = False
+            self._write()
+
+    def _receive(self, source):
+        self.states[source] = RankState(*self.comm.recv(source=source, tag=PROGRESS_TAG))
+        self.received[source] += 1
+        self.changed.add(source)
+
+    def _write(self):
+        if self.changed:
+            self.sink.write(self.states, sorted(self.changed))
+            self.changed = set()
+
+    def close(self):
+        """ Collective: write the final state of every rank and close the sink """
+        if self.request is not None:
+            self.request.Wait()
+        sent = self.comm.gather((self.sent, self.state.values()), root=0)
+        if self.myrank == 0:
+            # pick up the updates still in flight, then the final states
+            for source, (count, values) in enumerate(sent):
+                while self.received[source] < count:
+                    self._receive(source)
+                if source > 0:
+                    self.states[source] = RankState(*values)
+                self.changed.add(source)
+            self._write()
+            self.sink.close()
+        self.comm.Free()
@@ -0,0 +1,71 @@
+# project_corpus.py
+# optional stage between get_tfidf.py and clustering: project every track
+# into a few hundred dimensions (see projection.py) and write the result in
+# the binary corpus format read by k_means.py / k_means_mpi.py --corpus
+#
+# The projection is saved into the output directory as projection.npz.
+# Passing it back with --projection maps other tracks, e.g. new ones, into
+# the same space instead of fitting a new projection.
+
+import os
+import sys
+import argparse
+import numpy as np
+from read_tfidf import TFIDFDb
+from corpus import Corpus, PROJECTION_FILE
+from projection import Projection, METHODS, fit
+
+MXM_CORPUS = "mxm_tfidf.corpus"
+MXM_PROJECTED = "mxm_projected.corpus"
+
+DIMENSIONS = 200
+
+def read_corpus(path):
+    """ A tfidf database when path ends in .db, a binary corpus otherwise """
+    if path.endswith(".db"):
+        return TFIDFDb(path).corpus()
+    return Corpus.load(path)
+
+def main(input_path=MXM_CORPUS, output_dir=MXM_PROJECTED, ndims=DIMENSIONS,
+         method="svd", seed=None, projection_file=None):
+    dbg("Reading {}".format(input_path))
+    corpus = read_corpus(input_path)
+    if projection_file is not None:
+        projection = Projection.load(projection_file)
+        dbg("Mapping {} tracks with {} ({} dimensions)".format(
+                len(corpus), projection_file, projection.ndims))
+    else:
+        dbg("Fitting a {} projection of {} tracks, {} words into {} dimensions".format(
+                method, len(corpus), corpus.nwords, ndims))
+        projection = fit(corpus, ndims, method, np.random.RandomState(seed))
+        if "kept" in projection.params:
+            dbg("The dimensions keep {:.1%} of the squared length of the tracks".format(
+                    projection.params["kept"]))
+    projected = projection.project(corpus)
+    dbg("Writing {} tracks, {} dimensions to {}".format(
+            len(projected), projected.nwords, output_dir))
+    projected.save(output_dir)
+    projection.save(os.path.join(output_dir, PROJECTION_FILE))
+
+def dbg(message):
+    sys.stderr.write(message + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="project the tfidf corpus into fewer "
+                                                 "dimensions for clustering")
+    parser.add_argument("input", nargs="?", default=MXM_CORPUS,
+                        help="binary corpus written by export_corpus.py, or a tfidf "
+                             "database ending in .db (default {})".format(MXM_CORPUS))
+    parser.add_argument("output", nargs="?", default=MXM_PROJECTED,
+                        help="directory of the projected corpus (default {})".format(MXM_PROJECTED))
+    parser.add_argument("--dims", type=int, default=DIMENSIONS,
+                        help="number of dimensions (default {})".format(DIMENSIONS))
+    parser.add_argument("--method", choices=METHODS, default="svd",
+                        help="randomized truncated SVD or sparse random projection "
+                             "(default svd)")
+    parser.add_argument("--seed", type=int, help="random seed")
+    parser.add_argument("--projection", metavar="FILE",
+                        help="map the tracks with this saved projection (the {} of a "
+                             "projected corpus) instead of fitting one".format(PROJECTION_FILE))
+    args = parser.parse_args()
+    main(args.input, args.output, args.dims, args.method, args.seed, args.projection)
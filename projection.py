@@ -0,0 +1,146 @@
+# projection.py
+# map the tfidf corpus into a few hundred dimensions before clustering
+#
+# Tracks are scaled to unit length and multiplied with an (nwords, ndims)
+# matrix, either a very sparse random projection or the top right singular
+# vectors of the corpus found by randomized SVD.  The projected corpus is a
+# dense Corpus, a (tracks, ndims) matrix of values without word ids, which
+# both k-means scripts run on unchanged, with (K, ndims) centroids and
+# reductions instead of (K, nwords).  The projection is saved with the projected corpus, so new
+# tracks can be mapped into the same space later.
+
+import json
+import numpy as np
+from corpus import Corpus
+from assign import BLOCK_ELEMENTS, row_blocks, block_similarities
+
+METHODS = [ "svd", "random" ]
+
+# power iterations and extra columns of the randomized SVD, see Halko,
+# Martinsson and Tropp, "Finding structure with randomness" (2011)
+SVD_ITERATIONS = 2
+SVD_OVERSAMPLE = 10
+
+def dimension_names(ndims):
+    """ The vocabulary of a projected corpus """
+    return [u"dim{:03d}".format(i) for i in xrange(ndims)]
+
+def times(corpus, matrix, row_norms):
+    """ Unit-length rows of corpus times the (nwords, ncols) matrix """
+    result = np.empty((len(corpus), matrix.shape[1]))
+    for start, end in row_blocks(corpus, matrix.shape[1]):
+        result[start:end] = block_similarities(corpus, start, end, matrix, row_norms)
+    return result
+
+def transpose_times(corpus, matrix, row_norms):
+    """ Transpose of the unit-length rows of corpus times the (len(corpus),
+        ncols) matrix.  The nonzeros are visited in word order, so each
+        block is summed per word with reduceat. """
+    ncols = matrix.shape[1]
+    result = np.zeros((corpus.nwords, ncols))
+    order = np.argsort(corpus.word_ids, kind="mergesort")
+    rows = corpus.row_of_nonzeros()[order]
+    word_ids = corpus.word_ids[order]
+    weights = corpus.values[order] / row_norms[rows]
+    step = max(1, BLOCK_ELEMENTS // max(1, ncols))
+    for lo in xrange(0, corpus.nnz, step):
+        hi = min(lo + step, corpus.nnz)
+        products = matrix[rows[lo:hi]]
+        products *= weights[lo:hi, np.newaxis]
+        ids = word_ids[lo:hi]
+        starts = np.flatnonzero(np.append(True, ids[1:] != ids[:-1]))
+        result[ids[starts]] += np.add.reduceat(products, starts, axis=0)
+    return result
+
+def sparse_random(nwords, ndims, rng):
+    """ (nwords, ndims) very sparse random projection (Li, Hastie and Church
+        2006): every entry is +-sqrt(s / ndims) with probability 1 / 2s and
+        0 otherwise, s = sqrt(nwords).  Lengths and cosines are kept in
+        expectation. """
+    s = np.sqrt(nwords)
+    draw = rng.random_sample((nwords, ndims))
+    components = np.zeros((nwords, ndims))
+    components[draw < 1 / (2 * s)] = np.sqrt(s / ndims)
+    components[draw > 1 - 1 / (2 * s)] = -np.sqrt(s / ndims)
+    return components
+
+def randomized_svd(corpus, ndims, rng, row_norms=None, iterations=SVD_ITERATIONS,
+                   oversample=SVD_OVERSAMPLE):
+    """ Return (components, singular_values): the (nwords, ndims) top right
+        singular vectors of the corpus with unit-length rows and their
+        singular values.  The rows are not centered, as in LSA, so the
+        cosine between two projected tracks approximates the original. """
+    if row_norms is None:
+        row_norms = corpus.row_norms()
+    ndims = min(ndims, corpus.nwords)
+    ncols = min(ndims + oversample, corpus.nwords)
+    q = np.linalg.qr(times(corpus, rng.standard_normal((corpus.nwords, ncols)), row_norms))[0]
+    for i in xrange(iterations):
+        q = np.linalg.qr(transpose_times(corpus, q, row_norms))[0]
+        q = np.linalg.qr(times(corpus, q, row_norms))[0]
+    # Q^T A is only (ncols, nwords), its SVD is cheap
+    vt = np.linalg.svd(transpose_times(corpus, q, row_norms).T, full_matrices=False)
+    return vt[2][:ndims].T, vt[1][:ndims]
+
+class Projection(object):
+    """ Linear map of unit-length tfidf rows into ndims dimensions.
+
+        components -- (nwords, ndims) matrix
+        words      -- vocabulary of the original space
+        params     -- dictionary describing how it was made, stored as JSON
+    """
+
+    def __init__(self, components, words, params=None):
+        self.components = np.asarray(components, dtype=np.float64)
+        self.words = list(words)
+        self.params = params or {}
+
+    @property
+    def ndims(self):
+        return self.components.shape[1]
+
+    def components_for(self, words):
+        """ The components rearranged for another vocabulary, zero for
+            words this projection does not know """
+        if words == self.words:
+            return self.components
+        word_index = dict((word, i) for i, word in enumerate(self.words))
+        components = np.zeros((len(words), self.ndims))
+        for i, word in enumerate(words):
+            j = word_index.get(word)
+            if j is not None:
+                components[i] = self.components[j]
+        return components
+
+    def project(self, corpus):
+        """ Return corpus mapped into the projection, a dense Corpus """
+        values = times(corpus, self.components_for(corpus.words), corpus.row_norms())
+        ntracks, ndims = values.shape
+        return Corpus(np.arange(ntracks + 1, dtype=np.int64) * ndims, None, values,
+                      corpus.track_ids, dimension_names(ndims))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, components=self.components,
+                     words=np.array([word.encode('utf-8') for word in self.words]),
+                     params=np.array(json.dumps(self.params)))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["components"], [word.decode('utf-8') for word in data["words"]],
+                       json.loads(str(data["params"])))
+
+def fit(corpus, ndims, method="svd", rng=None):
+    """ Return a Projection of corpus into ndims dimensions.  For svd the
+        params record the share of the squared length of the unit rows the
+        dimensions keep. """
+    if rng is None:
+        rng = np.random.RandomState()
+    params = { "method": method, "ndims": ndims, "tracks": len(corpus) }
+    if method == "svd":
+        components, singular = randomized_svd(corpus, ndims, rng)
+        params["kept"] = float(np.sum(np.square(singular)) / max(len(corpus), 1))
+    else:
+        components = sparse_random(corpus.nwords, ndims, rng)
+    return Projection(components, corpus.words, params)
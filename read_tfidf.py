@@ -22,13 +22,16 @@ for track_id in all_tracks:
 from math import log
 import sqlite3
 import sys
+import numpy as np
+from corpus import Corpus
 
 class TFIDFDb(object):
     def __init__(self, db_file):
         self.db = sqlite3.connect(db_file)
     def tf_idf_by_track(self, track_id):
         """Return a dictionary of word->tfidf for the given track_id"""
-        c = self.db.execute("SELECT word, tfidf FROM tfidf WHERE track_id = ?", (track_id,))
+        c = self.db.execute("""SELECT word, tfidf FROM tfidf NATURAL JOIN vocabulary
+                               WHERE track_id = ?""", (track_id,))
         return dict(c.fetchall())
     def tf_idf_all(self):
         """ Return a dictionary of dictionaries of word->tfidf for all track ids 
@@ -40,7 +43,7 @@ class TFIDFDb(object):
             But this way is another way, which is useful with a large dataset
         """
         output = {}
-        c = self.db.execute("SELECT track_id, word, tfidf FROM tfidf")
+        c = self.db.execute("SELECT track_id, word, tfidf FROM tfidf NATURAL JOIN vocabulary")
 
         
         # row-by-row fetching loop
@@ -54,6 +57,47 @@ class TFIDFDb(object):
             output[track_id][word] = tfidf
             row = c.fetchone()  # fetch the next row
         return output
+    def vocabulary(self):
+        """ Return the list of every word in the database, the position of a
+            word in this list is its word_id """
+        c = self.db.execute("SELECT word FROM vocabulary ORDER BY word_id")
+        return [row[0] for row in c.fetchall()]
+    def idf(self):
+        """ Return the idf weight of every word_id as a numpy array """
+        c = self.db.execute("SELECT idf FROM vocabulary ORDER BY word_id")
+        return np.array([row[0] for row in c.fetchall()])
+    def corpus(self, track_ids=None, words=None, callback=None):
+        """ Return a Corpus (CSR matrix) holding the tfidf scores of the
+            given track_ids, or of every track when track_ids is None.
+
+            The word ids come straight from the database, words is only the
+            vocabulary attached to the Corpus and is read from the database
+            when None.  Rows are streamed straight into the CSR arrays, no
+            per-track dictionaries are built.
+        """
+        if words is None:
+            words = self.vocabulary()
+        query = "SELECT track_id, word_id, tfidf FROM tfidf"
+        if track_ids is not None:
+            query += " WHERE track_id IN ( '{}' )".format("','".join(track_ids))
+        query += " ORDER BY track_id"
+        return Corpus.from_rows(self.db.execute(query), words, callback)
+    def track_lengths(self):
+        """ Return the number of nonzeros of every track, in row order """
+        c = self.db.execute("SELECT nnz FROM tracks ORDER BY row")
+        return np.array([row[0] for row in c.fetchall()], dtype=np.int64)
+    def corpus_rows(self, start, end, words=None, callback=None):
+        """ Return a Corpus of the tracks in rows start:end of the tracks
+            table, read as one tfidf rowid range instead of an IN list """
+        if words is None:
+            words = self.vocabulary()
+        bounds = self.db.execute("""SELECT MIN(offset), MAX(offset + nnz) FROM tracks
+                                    WHERE row >= ? AND row < ?""", (start, end)).fetchone()
+        if bounds[0] is None:
+            return Corpus([0], [], [], [], words)
+        query = """SELECT track_id, word_id, tfidf FROM tfidf
+                   WHERE rowid > ? AND rowid <= ? ORDER BY rowid"""
+        return Corpus.from_rows(self.db.execute(query, bounds), words, callback)
     def track_ids(self):
         """ Return a list of all track_id in the database. Strip the 1-tuple
             off each bare track_id that is returned """
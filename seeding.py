@@ -0,0 +1,133 @@
+# seeding.py
+# initial centroids for k-means: uniform random tracks, k-means++ for the
+# sequential script and k-means|| (scalable k-means++) for the mpi script
+#
+# All functions take a numpy RandomState so runs can be repeated with the
+# same seed.  "Distance" here is the cosine distance 1 - cos(x, c), which
+# for unit vectors is half the squared euclidian distance k-means++ uses.
+
+import numpy as np
+from assign import assign, normalize_centroids
+
+def random_rows(corpus, k, rng):
+    """ Return k distinct corpus rows as a dense (k, nwords) array """
+    rows = rng.choice(len(corpus), k, replace=False)
+    return np.array([corpus.dense_row(i) for i in rows])
+
+def kmeans_plusplus(corpus, k, rng, row_norms=None, callback=None):
+    """ k-means++: pick each next centroid among the tracks with probability
+        proportional to its distance from the nearest centroid so far.
+        Costs one single-centroid assignment pass per centroid. """
+    if row_norms is None:
+        row_norms = corpus.row_norms()
+    centroids = [corpus.dense_row(rng.randint(len(corpus)))]
+    best = assign(corpus, centroids[-1:], row_norms)[1]
+    for i in xrange(1, k):
+        cost = np.maximum(1 - best, 0)
+        total = cost.sum()
+        if total > 0:
+            row = rng.choice(len(corpus), p=cost / total)
+        else:
+            row = rng.randint(len(corpus))
+        centroids.append(corpus.dense_row(row))
+        best = np.maximum(best, assign(corpus, centroids[-1:], row_norms)[1])
+        if callback is not None:
+            callback(i + 1)
+    return np.array(centroids)
+
+def weighted_plusplus(points, weights, k, rng):
+    """ Run k-means++ over a small dense set of weighted points and return
+        the indices of the k chosen points """
+    unit = normalize_centroids(points)
+    weights = np.asarray(weights, dtype=np.float64)
+    if weights.sum() > 0:
+        first = rng.choice(len(points), p=weights / weights.sum())
+    else:
+        first = rng.randint(len(points))
+    chosen = [first]
+    best = unit.dot(unit[first])
+    for i in xrange(1, k):
+        cost = weights * np.maximum(1 - best, 0)
+        cost[chosen] = 0
+        if cost.sum() > 0:
+            nxt = rng.choice(len(points), p=cost / cost.sum())
+        else:
+            # every point coincides with a chosen one, pick uniformly
+            remaining = np.setdiff1d(np.arange(len(points)), chosen)
+            nxt = rng.choice(remaining)
+        chosen.append(nxt)
+        best = np.maximum(best, unit.dot(unit[nxt]))
+    return chosen
+
+def row_offset(comm, corpus):
+    """ Return (offset, total): the global index of this rank's first row
+        and the number of rows on all ranks together """
+    counts = comm.allgather(len(corpus))
+    return sum(counts[:comm.Get_rank()]), sum(counts)
+
+def share_rows(comm, corpus, rows):
+    """ Every rank passes some of its local rows, every rank gets all of
+        them back as one dense array, in rank order.  The rows travel as
+        sparse (word_ids, values) pairs. """
+    mine = [(np.array(word_ids), np.array(values))
+            for word_ids, values in (corpus.row(i) for i in rows)]
+    shared = [row for part in comm.allgather(mine) for row in part]
+    dense = np.zeros((len(shared), corpus.nwords))
+    for j, (word_ids, values) in enumerate(shared):
+        dense[j, word_ids] = values
+    return dense
+
+def random_centroids(comm, corpus, k, rng):
+    """ k distinct tracks chosen uniformly over all ranks """
+    offset, total = row_offset(comm, corpus)
+    rows = None
+    if comm.Get_rank() == 0:
+        rows = rng.choice(total, k, replace=False)
+    rows = comm.bcast(rows, root=0)
+    local = [g - offset for g in rows if offset <= g < offset + len(corpus)]
+    return share_rows(comm, corpus, local)
+
+def kmeans_parallel(comm, corpus, k, rng, rounds=5, oversample=None,
+                    row_norms=None, callback=None):
+    """ k-means|| (Bahmani et al. 2012).  Each round every rank samples its
+        own tracks with probability oversample * distance / total distance,
+        the candidates are shared, and after a few rounds rank 0 reduces the
+        weighted candidates to k centroids with k-means++. """
+    if oversample is None:
+        oversample = 2 * k
+    if row_norms is None:
+        row_norms = corpus.row_norms()
+    myrank = comm.Get_rank()
+    offset, total = row_offset(comm, corpus)
+    first = None
+    if myrank == 0:
+        first = rng.randint(total)
+    first = comm.bcast(first, root=0)
+    local = [first - offset] if offset <= first < offset + len(corpus) else []
+    candidates = share_rows(comm, corpus, local)
+    best = assign(corpus, candidates, row_norms)[1]
+
+    for r in xrange(rounds):
+        cost = np.maximum(1 - best, 0)
+        phi = comm.allreduce(float(cost.sum()))
+        if phi <= 0:
+            break
+        picked = np.flatnonzero(rng.random_sample(len(corpus)) < oversample * cost / phi)
+        new = share_rows(comm, corpus, picked)
+        if len(new):
+            candidates = np.vstack([candidates, new])
+            best = np.maximum(best, assign(corpus, new, row_norms)[1])
+        if callback is not None:
+            callback(r + 1, len(candidates))
+
+    if len(candidates) < k:
+        return random_centroids(comm, corpus, k, rng)
+
+    # weight every candidate by the number of tracks closest to it
+    labels = assign(corpus, candidates, row_norms)[0]
+    weights = comm.allreduce(np.bincount(labels, minlength=len(candidates)))
+    chosen = None
+    if myrank == 0:
+        chosen = weighted_plusplus(candidates, weights, k, rng)
+    chosen = comm.bcast(chosen, root=0)
+    return candidates[chosen]
@@ -0,0 +1,79 @@
+# summary.py
+# describe clusters by their words, straight from the per-cluster sums
+#
+# Everything is computed on (k, nwords) arrays, there is no query per
+# cluster: the heaviest words of each cluster by mean tfidf, and the most
+# distinctive ones by lift, the cluster mean of a word over its corpus mean.
+
+import numpy as np
+from corpus import Corpus
+from assign import cluster_sums
+
+def top_columns(scores, n):
+    """ Column indices of the n largest entries of every row of scores,
+        largest first.  Only the n winners of each row are sorted. """
+    n = min(n, scores.shape[1])
+    rows = np.arange(len(scores))[:, np.newaxis]
+    part = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    order = np.argsort(-scores[rows, part], axis=1, kind="mergesort")
+    return part[rows, order]
+
+def word_counts(corpus, labels, k):
+    """ (k, nwords) number of tracks in each cluster that use each word """
+    ones = Corpus(corpus.indptr, None if corpus.dense else corpus.word_ids, np.ones(corpus.nnz),
+                  corpus.track_ids, corpus.words)
+    return cluster_sums(ones, labels, k)[0]
+
+class ClusterSummary(object):
+    """ Word statistics of k clusters.
+
+        sums and counts are the per-cluster tfidf sums and sizes, as
+        returned by assign.cluster_sums().  track_counts, from
+        word_counts(), is optional; with it distinctive_words() can ignore
+        words that only a few tracks of a cluster use.
+    """
+
+    def __init__(self, sums, counts, track_counts=None):
+        self.counts = np.asarray(counts, dtype=np.float64)
+        self.means = sums / np.maximum(self.counts, 1)[:, np.newaxis]
+        corpus_mean = sums.sum(axis=0) / max(self.counts.sum(), 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.lift = np.where(corpus_mean > 0, self.means / corpus_mean, 0)
+        self.track_counts = track_counts
+
+    def top_words(self, n=30):
+        """ Return (word_ids, means): the n words of every cluster with the
+            highest mean tfidf, as (k, n) arrays """
+        ids = top_columns(self.means, n)
+        return ids, self.means[np.arange(len(ids))[:, np.newaxis], ids]
+
+    def distinctive_words(self, n=30, min_tracks=2):
+        """ Return (word_ids, lifts): the n words of every cluster that are
+            most over-represented compared to the whole corpus.  With
+            track_counts, words used by fewer than min_tracks tracks of the
+            cluster are left out. """
+        lift = self.lift
+        if self.track_counts is not None:
+            lift = np.where(self.track_counts >= min_tracks, lift, 0)
+        ids = top_columns(lift, n)
+        return ids, lift[np.arange(len(ids))[:, np.newaxis], ids]
+
+    def report(self, words, n=30, min_tracks=2):
+        """ Text listing the top and the most distinctive words per cluster """
+        top_ids, means = self.top_words(n)
+        lift_ids, lifts = self.distinctive_words(n, min_tracks)
+        lines = []
+        for i in xrange(len(self.counts)):
+            lines.append("Cluster {} ({})".format(i, int(self.counts[i])))
+            lines.append("=" * 45)
+            lines.append("{:20} {:>10}   {:20} {:>8}".format("word", "mean", "word", "lift"))
+            for j in xrange(len(top_ids[i])):
+                top = lift = ""
+                if means[i, j] > 0:
+                    top = "{:20} {:10f}".format(words[top_ids[i, j]].encode('utf-8'), means[i, j])
+                if lifts[i, j] > 0:
+                    lift = "{:20} {:8.2f}".format(words[lift_ids[i, j]].encode('utf-8'), lifts[i, j])
+                if top or lift:
+                    lines.append("{:31}   {}".format(top, lift).rstrip())
+            lines.append("")
+        return "\n".join(lines)
@@ -0,0 +1,100 @@
+# synthetic.py
+# generate a synthetic lyrics database shaped like mxm_dataset.db
+#
+# Every song is a bag of tokens drawn from a Zipfian distribution over the
+# vocabulary; the number of tokens per song is log-normal.  Words that are
+# drawn more than once in a song give the counts, so the number of distinct
+# words per song and the counts per word come out the way they do in real
+# lyrics instead of being drawn separately.
+
+import sys
+import sqlite3
+import argparse
+import numpy as np
+
+NUM_WORDS = 5000
+NUM_TRACKS = 10000
+# these give about 80 distinct words per song and a mean count of 2.4,
+# close to mxm_dataset.db
+ZIPF_EXPONENT = 1.2
+# tokens per song: log-normal with this median and log standard deviation
+MEDIAN_TOKENS = 160
+SIGMA_TOKENS = 0.7
+TEST_FRACTION = 0.1
+
+# tracks generated per executemany() call
+BATCH_TRACKS = 2000
+
+def word_list(nwords):
+    return [u"w{:04d}".format(i) for i in xrange(nwords)]
+
+def zipf_probabilities(nwords, exponent=ZIPF_EXPONENT):
+    """ Probability of the word of every rank 1..nwords under Zipf's law """
+    weights = 1.0 / np.arange(1, nwords + 1) ** exponent
+    return weights / weights.sum()
+
+def track_id(i):
+    """ 18 characters, like the real TRAABRX12903CC4816 """
+    return "TRSYN{:013d}".format(i)
+
+def song_rows(first, ntracks, words, cumulative, rng, median=MEDIAN_TOKENS,
+              sigma=SIGMA_TOKENS):
+    """ Return the (track_id, mxm_tid, word, count, is_test) rows of tracks
+        first .. first+ntracks, ordered by track """
+    test = rng.random_sample(ntracks) < TEST_FRACTION
+    lengths = np.maximum(1, rng.lognormal(np.log(median), sigma, ntracks).astype(np.int64))
+    tokens = np.searchsorted(cumulative, rng.random_sample(lengths.sum()), side="right")
+    tokens = np.minimum(tokens, len(words) - 1)
+    tracks = np.repeat(np.arange(ntracks), lengths)
+    keys, counts = np.unique(tracks * len(words) + tokens, return_counts=True)
+    rows = keys // len(words)
+    word_ids = keys % len(words)
+    return [(track_id(first + r), first + r, words[w], c, int(test[r]))
+            for r, w, c in zip(rows.tolist(), word_ids.tolist(), counts.tolist())]
+
+def generate(path, ntracks=NUM_TRACKS, nwords=NUM_WORDS, exponent=ZIPF_EXPONENT,
+             median=MEDIAN_TOKENS, sigma=SIGMA_TOKENS, seed=None, callback=None):
+    """ Write a database with the lyrics and words tables of mxm_dataset.db
+        to path.  callback, if given, is called with the number of tracks
+        written after every batch. """
+    rng = np.random.RandomState(seed)
+    words = word_list(nwords)
+    cumulative = np.cumsum(zipf_probabilities(nwords, exponent))
+    db = sqlite3.connect(path)
+    c = db.cursor()
+    c.execute("PRAGMA journal_mode = OFF")
+    c.execute("PRAGMA synchronous = OFF")
+    c.execute("DROP TABLE IF EXISTS words")
+    c.execute("DROP TABLE IF EXISTS lyrics")
+    c.execute("CREATE TABLE words (word TEXT PRIMARY KEY)")
+    c.execute("""CREATE TABLE lyrics (track_id TEXT, mxm_tid INT, word TEXT,
+                 count INT, is_test INT)""")
+    c.executemany("INSERT INTO words VALUES ( ? )", ((word,) for word in words))
+    for first in xrange(0, ntracks, BATCH_TRACKS):
+        n = min(BATCH_TRACKS, ntracks - first)
+        c.executemany("INSERT INTO lyrics VALUES ( ?, ?, ?, ?, ? )",
+                      song_rows(first, n, words, cumulative, rng, median, sigma))
+        if callback is not None:
+            callback(first + n)
+    c.execute("CREATE INDEX idx_lyrics_track_id ON lyrics (track_id)")
+    db.commit()
+    db.close()
+
+def dbg(message):
+    sys.stderr.write(message + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="write a synthetic mxm_dataset.db")
+    parser.add_argument("output_db")
+    parser.add_argument("--tracks", type=int, default=NUM_TRACKS,
+                        help="number of songs (default {})".format(NUM_TRACKS))
+    parser.add_argument("--words", type=int, default=NUM_WORDS,
+                        help="vocabulary size (default {})".format(NUM_WORDS))
+    parser.add_argument("--zipf", type=float, default=ZIPF_EXPONENT,
+                        help="Zipf exponent of the word frequencies (default {})".format(ZIPF_EXPONENT))
+    parser.add_argument("--median-tokens", type=float, default=MEDIAN_TOKENS,
+                        help="median number of words per song (default {})".format(MEDIAN_TOKENS))
+    parser.add_argument("--seed", type=int, help="random seed")
+    args = parser.parse_args()
+    generate(args.output_db, args.tracks, args.words, args.zipf, args.median_tokens,
+             seed=args.seed, callback=lambda n: dbg("{} tracks".format(n)))
@@ -0,0 +1,112 @@
+# timing.py
+# per-phase wall time and communication volume of an mpi run
+#
+# Every rank adds up the time it spends in each named phase, per pass and
+# in total, along with the bytes it hands to MPI in that phase.  At the end
+# rank 0 gathers all ranks and reduces them to min / max / mean and an
+# imbalance ratio (max / mean) per phase, which is written as JSON.
+
+import json
+import os
+import cProfile
+from time import time
+from contextlib import contextmanager
+from collections import defaultdict
+
+class Timings(object):
+    """ Phase timer of one rank.
+
+        With wait_barrier, wait() times an explicit Barrier, so the time a
+        rank idles for slower ones shows up as its own "wait" phase instead
+        of inflating the collective that follows.  Without it wait() does
+        nothing and the run is not changed by the measurement.
+    """
+
+    def __init__(self, wait_barrier=False):
+        self.wait_barrier = wait_barrier
+        self.seconds = defaultdict(float)
+        self.bytes = defaultdict(int)
+        self.passes = []
+        self.current = defaultdict(float)
+        self.current_bytes = defaultdict(int)
+
+    @contextmanager
+    def phase(self, name, nbytes=0):
+        """ Time the with block as phase name, which sends nbytes """
+        start = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - start
+            self.seconds[name] += elapsed
+            self.current[name] += elapsed
+            self.bytes[name] += nbytes
+            self.current_bytes[name] += nbytes
+
+    def wait(self, comm):
+        if self.wait_barrier:
+            with self.phase("wait"):
+                comm.Barrier()
+
+    def begin_pass(self):
+        """ Phases from here to end_pass() count towards the next pass """
+        self.current = defaultdict(float)
+        self.current_bytes = defaultdict(int)
+
+    def end_pass(self):
+        self.passes.append((dict(self.current), dict(self.current_bytes)))
+        self.begin_pass()
+
+    def report(self, comm):
+        """ Collective: return the summary of all ranks on rank 0, None
+            elsewhere """
+        mine = (dict(self.seconds), dict(self.bytes), self.passes)
+        ranks = comm.gather(mine, root=0)
+        if ranks is None:
+            return None
+        names = sorted(set(name for seconds, nbytes, passes in ranks for name in seconds))
+        phases = {}
+        for name in names:
+            phases[name] = { "seconds": spread([r[0].get(name, 0.0) for r in ranks]),
+                             "bytes": spread([r[1].get(name, 0) for r in ranks]) }
+        npasses = max(len(r[2]) for r in ranks)
+        passes = []
+        for i in xrange(npasses):
+            times = [r[2][i] if i < len(r[2]) else ({}, {}) for r in ranks]
+            passes.append(dict((name, { "seconds": spread([t.get(name, 0.0) for t, b in times]),
+                                        "bytes": spread([b.get(name, 0) for t, b in times]) })
+                               for name in names if any(name in t for t, b in times)))
+        return { "ranks": len(ranks),
+                 "passes": npasses,
+                 "phases": phases,
+                 "per_pass": passes,
+                 "per_rank": dict((name, [r[0].get(name, 0.0) for r in ranks])
+                                  for name in names) }
+
+def spread(values):
+    """ min, max, mean, total and max / mean of one value over the ranks """
+    total = sum(values)
+    mean = total / float(len(values))
+    return { "min": min(values), "max": max(values), "mean": mean, "total": total,
+             "imbalance": max(values) / mean if mean > 0 else 1.0 }
+
+def write_report(path, report):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+def start_profile():
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+def stop_profile(profile, directory, rank):
+    """ Dump the profile of this rank to directory/rank<rank>.prof, read it
+        with pstats or snakeviz """
+    profile.disable()
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass     # another rank made it first
+    profile.dump_stats(os.path.join(directory, "rank{}.prof".format(rank)))
@@ -1,16 +1,36 @@
 #!/usr/bin/env python
 # track_lookup.py
-# quickly lookup the metadata + bag of words for a specific track
+# quickly lookup the metadata + bag of words for a specific track, the
+# metadata of many tracks at once (--batch, --clusters FILE), or place many
+# tracks in the clusters of a saved model (k_means*.py --model FILE)
 
 import sys
+import csv
+import json
 import sqlite3
+import argparse
+from collections import OrderedDict
 
 METADATA_DB = "track_metadata.db"
 MXM_DB = "mxm_dataset.db"
 
+# track ids per IN ( ?, ... ) query, below sqlite's limit of 999 parameters
+CHUNK_SIZE = 500
+# tracks classified at once
+BATCH_SIZE = 10000
+
 md_fields = [ 'artist_name', 'title', 'release', 'year', 'duration' ]
 field_len = max(map(lambda x: len(x), md_fields))
 
+FORMATS = [ "csv", "jsonl" ]
+
+def connect(path):
+    """ Connection to path that refuses to write, safe to share between
+        all the lookups of a run """
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA query_only = ON")
+    return db
+
 def get_metadata(track_id, mdd):
     query = "SELECT " + ", ".join(md_fields) + " FROM songs WHERE track_id = ?"
     c = mdd.cursor()
@@ -29,6 +49,195 @@ def get_mxmdata(track_id, mxm):
     return c.fetchall()
 
 
+def chunks(items, size):
+    for start in xrange(0, len(items), size):
+        yield items[start:start+size]
+
+def chunks_of(iterable, size):
+    """ chunks() for iterables without a length, yields lists """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def get_bags(track_ids, mxm):
+    """ Yield (track_id, [(word, count), ...]) for every one of track_ids
+        found in the lyrics table, a few hundred ids per query; ids that
+        are not there are skipped """
+    c = mxm.cursor()
+    for chunk in chunks(list(track_ids), CHUNK_SIZE):
+        query = """SELECT track_id, word, count FROM lyrics
+                   WHERE track_id IN ( {} ) ORDER BY track_id""".format(", ".join("?" * len(chunk)))
+        bag = []
+        last = None
+        for track_id, word, count in c.execute(query, chunk):
+            if track_id != last:
+                if last is not None:
+                    yield last, bag
+                last, bag = track_id, []
+            bag.append((word, count))
+        if last is not None:
+            yield last, bag
+
+class MetadataIndex(object):
+    """ Metadata of tracks by track_id over one read-only connection.
+
+        Lookups go a chunk of CHUNK_SIZE ids per IN ( ?, ... ) query, and
+        every row found is kept in memory, so a track is read from sqlite
+        only once however often it is asked for.  With preload the whole
+        songs table is read up front in a single scan, which beats the
+        indexed queries when a large part of the tracks is looked up.
+    """
+
+    def __init__(self, path=METADATA_DB, preload=False):
+        self.db = connect(path)
+        self.rows = {}
+        self.complete = False
+        if preload:
+            query = "SELECT track_id, " + ", ".join(md_fields) + " FROM songs"
+            for row in self.db.execute(query):
+                self.rows[row[0]] = row[1:]
+            self.complete = True
+
+    def fetch(self, track_ids):
+        """ Read the rows of track_ids that are not in memory yet """
+        if self.complete:
+            return
+        missing = sorted(set(track_id for track_id in track_ids
+                             if track_id not in self.rows))
+        for chunk in chunks(missing, CHUNK_SIZE):
+            query = "SELECT track_id, {} FROM songs WHERE track_id IN ( {} )".format(
+                    ", ".join(md_fields), ", ".join("?" * len(chunk)))
+            for row in self.db.execute(query, chunk):
+                self.rows[row[0]] = row[1:]
+
+    def lookup(self, track_ids):
+        """ Yield (track_id, row) in the order of track_ids, row is the
+            md_fields values or None for unknown tracks """
+        for chunk in chunks(track_ids, CHUNK_SIZE):
+            self.fetch(chunk)
+            for track_id in chunk:
+                yield track_id, self.rows.get(track_id)
+
+    def close(self):
+        self.db.close()
+
+def read_clusters(lines):
+    """ Yield (track_id, cluster) from a *_clusters output file """
+    cluster = None
+    for line in lines:
+        line = line.strip()
+        if line.startswith("Cluster "):
+            cluster = int(line.split()[1])
+        elif line and cluster is not None and not line.startswith("="):
+            yield line, cluster
+
+class CSVOutput(object):
+    def __init__(self, f, fields):
+        self.writer = csv.writer(f)
+        self.writer.writerow(fields)
+
+    def write(self, values):
+        self.writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value
+                              for value in values])
+
+class JSONLinesOutput(object):
+    def __init__(self, f, fields):
+        self.f = f
+        self.fields = fields
+
+    def write(self, values):
+        self.f.write(json.dumps(OrderedDict(zip(self.fields, values))) + "\n")
+
+OUTPUTS = { "csv": CSVOutput, "jsonl": JSONLinesOutput }
+
+def main_batch(tracks, output_format="csv", preload=False, out=sys.stdout):
+    """ Write the metadata of tracks, (track_id, cluster) pairs with cluster
+        None when there is none, as they come; tracks not in the metadata
+        database get empty fields """
+    index = MetadataIndex(METADATA_DB, preload)
+    output = None
+    nmissing = 0
+    # ids are buffered a chunk at a time so the output streams
+    for chunk in chunks_of(tracks, CHUNK_SIZE):
+        if output is None:
+            fields = [ 'track_id' ] + md_fields
+            if chunk[0][1] is not None:
+                fields.insert(1, 'cluster')
+            output = OUTPUTS[output_format](out, fields)
+        rows = index.lookup([track_id for track_id, cluster in chunk])
+        for (track_id, cluster), (_, row) in zip(chunk, rows):
+            if row is None:
+                nmissing += 1
+                row = [ None ] * len(md_fields)
+            values = [ track_id ] + list(row)
+            if cluster is not None:
+                values.insert(1, cluster)
+            output.write(values)
+    index.close()
+    if nmissing:
+        sys.stderr.write("{} tracks not found in metadata database\n".format(nmissing))
+
+def classify_bags(model, bags, top=1, batch_size=BATCH_SIZE):
+    """ Yield (track_id, labels, scores) for (track_id, bag) pairs, see
+        Model.classify() """
+    batch = []
+    for item in bags:
+        batch.append(item)
+        if len(batch) == batch_size:
+            for row in _classify_batch(model, batch, top):
+                yield row
+            batch = []
+    if batch:
+        for row in _classify_batch(model, batch, top):
+            yield row
+
+def _classify_batch(model, batch, top):
+    track_ids = [track_id for track_id, bag in batch]
+    corpus = model.corpus(track_ids, [bag for track_id, bag in batch])
+    labels, scores = model.classify(corpus, top)
+    return zip(track_ids, labels.tolist(), scores.tolist())
+
+def read_ids(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield line
+
+def read_counts(lines):
+    """ Bags from JSON lines {"track_id": ..., "counts": {word: count, ...}} """
+    for line in lines:
+        if line.strip():
+            record = json.loads(line)
+            yield record["track_id"], record["counts"].items()
+
+def main_classify(model_file, track_ids, counts=False, top=1):
+    from model import Model
+    model = Model.load(model_file)
+    mxm = None
+    if counts:
+        bags = read_counts(sys.stdin)
+    else:
+        mxm = connect(MXM_DB)
+        if not track_ids:
+            track_ids = list(read_ids(sys.stdin))
+        bags = get_bags(track_ids, mxm)
+    nfound = 0
+    for track_id, labels, scores in classify_bags(model, bags, top):
+        print("{}\t{}".format(track_id, "\t".join("{}:{:.6f}".format(label, score)
+                                                   for label, score in zip(labels, scores))))
+        nfound += 1
+    if mxm is not None:
+        mxm.close()
+        # get_bags() yields nothing for ids without lyrics
+        nmissing = len(set(track_ids)) - nfound
+        if nmissing:
+            sys.stderr.write("{} tracks not found in mxm database\n".format(nmissing))
+
 def main(track_id, show_words):
 
     mdd = sqlite3.connect(METADATA_DB)
@@ -56,15 +265,42 @@ def main(track_id, show_words):
         mxm.close()
 
 if __name__ == "__main__":
-    trackid = None
-    show_words = False
-    for arg in sys.argv[1:]:
-        if arg == '-w':
-            show_words = True
-        else:
-            trackid = arg
-    if trackid:
-        main(trackid, show_words)
+    parser = argparse.ArgumentParser(description="look up tracks in {} and {}".format(
+                                     METADATA_DB, MXM_DB))
+    parser.add_argument("track_ids", nargs="*", metavar="track_id")
+    parser.add_argument("-w", dest="show_words", action="store_true",
+                        help="also show the bag of words")
+    parser.add_argument("--batch", action="store_true",
+                        help="print the metadata of every track given, or of the ids "
+                             "read from stdin when none are, one row each")
+    parser.add_argument("--clusters", metavar="FILE",
+                        help="like --batch for every track of a *_clusters output file, "
+                             "with its cluster")
+    parser.add_argument("--format", choices=FORMATS, default="csv",
+                        help="output of --batch and --clusters (default csv)")
+    parser.add_argument("--index", action="store_true",
+                        help="with --batch or --clusters, read the whole metadata table "
+                             "into memory first instead of querying it per chunk")
+    parser.add_argument("--classify", metavar="MODEL",
+                        help="print the nearest clusters of MODEL for every track, "
+                             "tab separated cluster:similarity; ids are read from "
+                             "stdin when none are given")
+    parser.add_argument("--counts", action="store_true",
+                        help="with --classify, read JSON lines {\"track_id\": ..., "
+                             "\"counts\": {word: count}} from stdin instead of ids")
+    parser.add_argument("--top", type=int, default=1,
+                        help="with --classify, number of clusters per track (default 1)")
+    args = parser.parse_args()
+    if args.classify:
+        main_classify(args.classify, args.track_ids, args.counts, args.top)
+    elif args.clusters:
+        with open(args.clusters) as f:
+            main_batch(read_clusters(f), args.format, args.index)
+    elif args.batch:
+        track_ids = args.track_ids or read_ids(sys.stdin)
+        main_batch(((track_id, None) for track_id in track_ids), args.format, args.index)
+    elif len(args.track_ids) == 1:
+        main(args.track_ids[0], args.show_words)
     else:
-        sys.stderr.write("USAGE: {} track_id\n".format(sys.argv[0]))
+        parser.print_usage(sys.stderr)
         sys.exit(64)
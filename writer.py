@@ -0,0 +1,53 @@
+# writer.py
+# write output files on a background thread, off the critical path
+#
+# k_means_mpi.py hands the state of a pass to the writer and goes straight on
+# with the next pass.  The queue holds at most one pending job, so a slow
+# disk makes the next hand-off wait instead of piling up copies of the labels.
+
+import sys
+import traceback
+from threading import Thread
+from Queue import Queue
+
+class BackgroundWriter(object):
+    """ Runs submitted jobs one at a time, in order, on a daemon thread.
+        After a job raises the remaining jobs are dropped and the error is
+        raised again from the next submit() or close(). """
+
+    def __init__(self, pending=1):
+        self.queue = Queue(pending)
+        self.error = None
+        self.thread = Thread(target=self._run, name="writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if self.error is not None:
+                continue
+            func, args = job
+            try:
+                func(*args)
+            except Exception:
+                self.error = sys.exc_info()
+                traceback.print_exc()
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+
+    def submit(self, func, *args):
+        """ Call func(*args) on the writer thread.  The arguments must not
+            be modified afterwards, pass copies of anything that is. """
+        self._check()
+        self.queue.put((func, args))
+
+    def close(self):
+        """ Wait for all submitted jobs to finish """
+        self.queue.put(None)
+        self.thread.join()
+        self._check()